@@ -1,11 +1,14 @@
 from fastapi.security import APIKeyHeader
-from fastapi import HTTPException, Security
+from fastapi import Header, HTTPException, Request, Security
 import dotenv
+import hashlib
+import hmac
 import os
 
 dotenv.load_dotenv()
 
 API_KEY = os.getenv("API_KEY")
+WEBHOOK_SECRET = os.getenv("GITHUB_WEBHOOK_SECRET")
 
 api_key_header = APIKeyHeader(name="api-key")
 
@@ -14,3 +17,15 @@ async def get_api_key(api_key: str = Security(api_key_header)):
     if api_key != API_KEY:
         raise HTTPException(status_code=403, detail="Not authenticated")
     return api_key
+
+
+async def verify_signature(
+    request: Request, x_hub_signature_256: str | None = Header(None)
+):
+    if not WEBHOOK_SECRET or x_hub_signature_256 is None:
+        raise HTTPException(status_code=403, detail="Invalid signature")
+
+    body = await request.body()
+    digest = hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(f"sha256={digest}", x_hub_signature_256):
+        raise HTTPException(status_code=403, detail="Invalid signature")
@@ -0,0 +1,57 @@
+import threading
+import time
+from sqlalchemy.ext.asyncio import AsyncSession
+from api.payloads import Payload
+from api.services import get_latest_run_id
+
+# Seconds a looked-up crawl generation is trusted before the DB is asked again
+GENERATION_CHECK_INTERVAL = 5.0
+
+
+class ResponseCache:
+    """Serialized responses keyed by endpoint and user, valid for one crawl run."""
+
+    def __init__(
+        self, check_interval: float = GENERATION_CHECK_INTERVAL, clock=time.monotonic
+    ):
+        self.check_interval = check_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.generations = {}
+        self.entries = {}
+
+    async def generation(self, db: AsyncSession, username: str | None = None) -> int:
+        now = self.clock()
+        with self.lock:
+            checked = self.generations.get(username)
+        if checked is not None and now - checked[0] < self.check_interval:
+            return checked[1]
+
+        run_id = await get_latest_run_id(db, username)
+        with self.lock:
+            self.generations[username] = (now, run_id)
+        return run_id
+
+    def get(self, name: str, username: str | None, run_id: int) -> Payload | None:
+        with self.lock:
+            entry = self.entries.get((name, username))
+        if entry is None or entry[0] != run_id:
+            return None
+        return entry[1]
+
+    def set(self, name: str, username: str | None, run_id: int, payload: Payload):
+        with self.lock:
+            self.entries[(name, username)] = (run_id, payload)
+
+    def expire(self):
+        # The next read looks up the latest crawl run again
+        with self.lock:
+            self.generations.clear()
+
+    def clear(self):
+        with self.lock:
+            self.generations.clear()
+            self.entries.clear()
+
+
+response_cache = ResponseCache()
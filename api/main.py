@@ -1,5 +1,8 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, Depends
-from api.routers import router
+from api.refresher import refresher
+from db.core import async_engine
+from api.routers import router, webhook_router
 from api.limiter import limiter
 from slowapi.errors import RateLimitExceeded
 from slowapi import _rate_limit_exceeded_handler
@@ -7,7 +10,15 @@ from api.auth import get_api_key
 from fastapi.middleware.cors import CORSMiddleware
 
 
-app = FastAPI(dependencies=[Depends(get_api_key)])
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    refresher.start()
+    yield
+    refresher.stop()
+    await async_engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "https://benceluzsinszky.com",
@@ -23,11 +34,13 @@ app.add_middleware(
 )
 
 app.state.limiter = limiter
-app.include_router(router)
+# GitHub authenticates webhooks with a signature instead of the API key
+app.include_router(router, dependencies=[Depends(get_api_key)])
+app.include_router(webhook_router)
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 
-@app.get("/")
+@app.get("/", dependencies=[Depends(get_api_key)])
 @limiter.limit("10/minute")
 async def root(request: Request):
     return {"message": "Server online"}
@@ -1,29 +1,14 @@
 from pydantic import BaseModel
-from datetime import datetime
-
-
-class LastYearContributions(BaseModel):
-    id: int
-    date: datetime
-    count: int
-    level: int
-    date_created: datetime
-
-
-class TotalContributions(BaseModel):
-    id: int
-    total_contributions: int
-    date_created: datetime
-
-
-class LanguageUsage(BaseModel):
-    id: int
-    language: str
-    count: int
-    date_created: datetime
-
-
-class TotalLines(BaseModel):
-    id: int
-    total_lines: int
-    date_created: datetime
+from db.schemas import (
+    LastYearContributions,
+    TotalContributions,
+    LanguageUsage,
+    TotalLines,
+)
+
+
+class Summary(BaseModel):
+    last_year_contributions: list[LastYearContributions] | None = None
+    total_contributions: TotalContributions | None = None
+    language_usage: list[LanguageUsage] | None = None
+    total_lines: TotalLines | None = None
@@ -0,0 +1,60 @@
+import hashlib
+import os
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import NamedTuple
+import dotenv
+
+dotenv.load_dotenv()
+
+CACHE_MAX_AGE = int(os.getenv("CACHE_MAX_AGE", 300))
+CACHE_STALE_WHILE_REVALIDATE = int(os.getenv("CACHE_STALE_WHILE_REVALIDATE", 3600))
+
+
+class Payload(NamedTuple):
+    content: bytes
+    gzip_content: bytes
+    etag: str
+    last_modified: datetime
+
+
+def make_payload(content, gzip_content, date_created) -> Payload:
+    digest = hashlib.sha256(content).hexdigest()[:32]
+    # date_created is naive local time, HTTP dates are whole seconds in GMT
+    last_modified = date_created.astimezone(timezone.utc).replace(microsecond=0)
+    return Payload(content, gzip_content, digest, last_modified)
+
+
+def cache_headers(payload: Payload, compressed: bool) -> dict[str, str]:
+    # Each encoding is a different byte sequence, so it gets its own strong ETag
+    etag = f'"{payload.etag}-gzip"' if compressed else f'"{payload.etag}"'
+    return {
+        "ETag": etag,
+        "Last-Modified": format_datetime(payload.last_modified, usegmt=True),
+        "Cache-Control": (
+            f"public, max-age={CACHE_MAX_AGE}, "
+            f"stale-while-revalidate={CACHE_STALE_WHILE_REVALIDATE}"
+        ),
+        "Vary": "Accept-Encoding",
+    }
+
+
+def is_not_modified(headers, etag: str, last_modified: datetime) -> bool:
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag in tags
+
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since is None:
+        return False
+
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return last_modified <= since
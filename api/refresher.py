@@ -0,0 +1,120 @@
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from queue import Empty, Queue
+import dotenv
+from api.cache import response_cache
+from crawler.crawler import Crawler, options_from_env
+from crawler.daemon import LOCK_PATH, crawl_lock
+from db.core import session_local
+
+dotenv.load_dotenv()
+
+# Seconds to wait for a running crawl to release the lock before retrying
+LOCK_RETRY_DELAY = 60
+
+
+def crawled_users():
+    usernames = os.getenv("USERNAMES") or os.getenv("USERNAME") or ""
+    return {username.strip() for username in usernames.split(",") if username}
+
+
+def default_user():
+    # Requests without a user read the main account, not the last crawled user
+    usernames = os.getenv("USERNAMES") or ""
+    return os.getenv("USERNAME") or usernames.split(",")[0].strip() or None
+
+
+def format_pushed_at(pushed_at):
+    # Push payloads carry a Unix timestamp where the API lists an ISO 8601 string
+    if isinstance(pushed_at, int):
+        return datetime.fromtimestamp(pushed_at, timezone.utc).strftime(
+            "%Y-%m-%dT%H:%M:%SZ"
+        )
+    return pushed_at
+
+
+class RepoRefresher:
+    def __init__(
+        self,
+        token: str,
+        session_factory=session_local,
+        options_factory=options_from_env,
+        lock_path: str = LOCK_PATH,
+        retry_delay: float = LOCK_RETRY_DELAY,
+    ):
+        self.token = token
+        self.session_factory = session_factory
+        self.options_factory = options_factory
+        self.lock_path = lock_path
+        self.retry_delay = retry_delay
+        self.queue = Queue()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.logger = logging.getLogger("CrawlerLogger").getChild("webhook")
+
+    def enqueue(self, username, repo, pushed_at):
+        self.queue.put((username, repo, format_pushed_at(pushed_at)))
+
+    def _drain(self, first):
+        # Pushes that arrived during the last refresh are handled in one run
+        pushed = {}
+        item = first
+        while item is not None:
+            username, repo, pushed_at = item
+            pushed.setdefault(username, {})[repo] = pushed_at
+            try:
+                item = self.queue.get_nowait()
+            except Empty:
+                item = None
+        return pushed
+
+    def refresh(self, username, pushed):
+        # A few pushed repos are counted in-process, not in a pool forked from uvicorn
+        options = {**self.options_factory(), "workers": 1}
+        db = self.session_factory()
+        crawler = None
+        try:
+            crawler = Crawler(username=username, token=self.token, db=db, **options)
+            crawler.refresh_repos(pushed)
+        finally:
+            if crawler is not None:
+                crawler.requester.close()
+            db.close()
+        response_cache.expire()
+
+    def _work(self):
+        while not self.stopped.is_set():
+            item = self.queue.get()
+            if item is None:
+                return
+
+            pushed = self._drain(item)
+            with crawl_lock(self.lock_path) as locked:
+                if locked:
+                    for username, repos in pushed.items():
+                        try:
+                            self.refresh(username, repos)
+                        except Exception as e:
+                            self.logger.error(f"Refreshing {username} failed: {str(e)}")
+                    continue
+
+            self.logger.info("A crawl is in progress, retrying the refresh later")
+            for username, repos in pushed.items():
+                for repo, pushed_at in repos.items():
+                    self.queue.put((username, repo, pushed_at))
+            self.stopped.wait(self.retry_delay)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.queue.put(None)
+        if self.thread is not None:
+            self.thread.join()
+
+
+refresher = RepoRefresher(os.getenv("GITHUB_PAT"))
@@ -1,33 +1,119 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
+from functools import partial
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.orm import Session
-from db.core import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.core import get_async_db
 from api.services import (
     get_db_last_year_contributions,
     get_db_total_contributions,
     get_db_language_usage,
     get_db_total_lines,
+    get_db_payload,
+    get_db_payloads,
 )
 from api.models import (
     LastYearContributions,
     TotalContributions,
     LanguageUsage,
     TotalLines,
+    Summary,
 )
+from api.auth import verify_signature
+from api.cache import response_cache
 from api.limiter import limiter
+from api.payloads import cache_headers, is_not_modified, make_payload
+from db.payloads import compress, encode_payload
+from api.refresher import crawled_users, default_user, refresher
 
 
 router = APIRouter()
+webhook_router = APIRouter()
+
+SECTION_SERVICES = {
+    "last_year_contributions": get_db_last_year_contributions,
+    "total_contributions": get_db_total_contributions,
+    "language_usage": get_db_language_usage,
+    "total_lines": get_db_total_lines,
+}
+
+
+async def load_payload(name, load, db, user, run_id, payload=None):
+    if payload is None:
+        payload = await get_db_payload(db, name, run_id)
+    if payload is not None:
+        return make_payload(payload.content, payload.gzip_content, payload.date_created)
+
+    # Runs crawled before payloads were written are serialized here instead
+    value = await load(db, user, run_id)
+    rows = value if isinstance(value, list) else [value]
+    date_created = max(row.date_created for row in rows)
+    return make_payload(*encode_payload(name, value), date_created)
+
+
+async def load_summary(sections, db, user, run_id):
+    payloads = {name: response_cache.get(name, user, run_id) for name in sections}
+    missing = [name for name, payload in payloads.items() if payload is None]
+    # All missing sections are read with one query in the request's transaction
+    stored = {
+        payload.name: payload for payload in await get_db_payloads(db, missing, run_id)
+    }
+    for name in missing:
+        try:
+            payloads[name] = await load_payload(
+                name, SECTION_SERVICES[name], db, user, run_id, stored.get(name)
+            )
+        except NoResultFound:
+            continue
+        response_cache.set(name, user, run_id, payloads[name])
+
+    found = [payload for payload in payloads.values() if payload is not None]
+    if not found:
+        raise NoResultFound
+
+    content = b"{%s}" % b",".join(
+        b'"%s":%s' % (name.encode(), b"null" if payload is None else payload.content)
+        for name, payload in payloads.items()
+    )
+    last_modified = max(payload.last_modified for payload in found)
+    return make_payload(content, compress(content), last_modified)
+
+
+async def section_response(request, name, db, user):
+    user = user or default_user()
+    load = partial(load_payload, name, SECTION_SERVICES[name])
+    return await cached_response(request, name, load, db, user)
+
+
+async def cached_response(request, name, build, db, user):
+    run_id = await response_cache.generation(db, user)
+    payload = response_cache.get(name, user, run_id)
+    if payload is None:
+        payload = await build(db, user, run_id)
+        response_cache.set(name, user, run_id, payload)
+
+    compressed = "gzip" in request.headers.get("accept-encoding", "")
+    headers = cache_headers(payload, compressed)
+    if is_not_modified(request.headers, headers["ETag"], payload.last_modified):
+        return Response(status_code=304, headers=headers)
+
+    content = payload.content
+    if compressed:
+        headers["Content-Encoding"] = "gzip"
+        content = payload.gzip_content
+
+    return Response(content=content, media_type="application/json", headers=headers)
 
 
 @router.get("/last_year_contributions")
 @limiter.limit("10/minute")
 async def get_last_year_contributions(
-    request: Request, last: bool | None = None, db: Session = Depends(get_db)
+    request: Request,
+    last: bool | None = None,
+    user: str | None = None,
+    db: AsyncSession = Depends(get_async_db),
 ) -> list[LastYearContributions]:
     try:
-        contributions = get_db_last_year_contributions(db)
-        return contributions
+        return await section_response(request, "last_year_contributions", db, user)
 
     except NoResultFound:
         raise HTTPException(status_code=204, detail="No contributions in DB")
@@ -36,11 +122,13 @@ async def get_last_year_contributions(
 @router.get("/total_contributions")
 @limiter.limit("10/minute")
 async def get_total_contributions(
-    request: Request, last: bool | None = None, db: Session = Depends(get_db)
+    request: Request,
+    last: bool | None = None,
+    user: str | None = None,
+    db: AsyncSession = Depends(get_async_db),
 ) -> TotalContributions:
     try:
-        contributions = get_db_total_contributions(db)
-        return contributions
+        return await section_response(request, "total_contributions", db, user)
 
     except NoResultFound:
         raise HTTPException(status_code=204, detail="No contributions in DB")
@@ -49,11 +137,10 @@ async def get_total_contributions(
 @router.get("/language_usage")
 @limiter.limit("10/minute")
 async def get_language_usage(
-    request: Request, db: Session = Depends(get_db)
+    request: Request, user: str | None = None, db: AsyncSession = Depends(get_async_db)
 ) -> list[LanguageUsage]:
     try:
-        language_usage = get_db_language_usage(db)
-        return language_usage
+        return await section_response(request, "language_usage", db, user)
 
     except NoResultFound:
         raise HTTPException(status_code=204, detail="No contributions in DB")
@@ -62,11 +149,68 @@ async def get_language_usage(
 @router.get("/total_lines")
 @limiter.limit("10/minute")
 async def get_total_lines(
-    request: Request, db: Session = Depends(get_db)
+    request: Request, user: str | None = None, db: AsyncSession = Depends(get_async_db)
 ) -> TotalLines:
     try:
-        total_lines = get_db_total_lines(db)
-        return total_lines
+        return await section_response(request, "total_lines", db, user)
 
     except NoResultFound:
         raise HTTPException(status_code=204, detail="No contributions in DB")
+
+
+@router.get("/summary")
+@limiter.limit("10/minute")
+async def get_summary(
+    request: Request,
+    sections: str | None = None,
+    user: str | None = None,
+    db: AsyncSession = Depends(get_async_db),
+) -> Summary:
+    requested = set(SECTION_SERVICES)
+    if sections is not None:
+        requested = {section.strip() for section in sections.split(",")} - {""}
+
+    unknown = requested - set(SECTION_SERVICES)
+    if unknown or not requested:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown sections: {', '.join(sorted(unknown))}"
+        )
+
+    names = [name for name in SECTION_SERVICES if name in requested]
+    user = user or default_user()
+    try:
+        return await cached_response(
+            request,
+            f"summary:{','.join(names)}",
+            partial(load_summary, names),
+            db,
+            user,
+        )
+
+    except NoResultFound:
+        raise HTTPException(status_code=204, detail="No contributions in DB")
+
+
+@webhook_router.post(
+    "/webhook/github", status_code=202, dependencies=[Depends(verify_signature)]
+)
+@limiter.limit("60/minute")
+async def github_webhook(request: Request, x_github_event: str = Header(...)):
+    if x_github_event == "ping":
+        return {"message": "pong"}
+    if x_github_event != "push":
+        return {"message": f"Ignored {x_github_event} event"}
+
+    payload = await request.json()
+    repository = payload["repository"]
+    owner = repository["owner"].get("login") or repository["owner"]["name"]
+    if owner not in crawled_users():
+        return {"message": f"Ignored push to {repository['full_name']}"}
+    # The crawl only lists public repositories and counts their default branch
+    if repository.get("private"):
+        return {"message": f"Ignored push to private {repository['full_name']}"}
+    if payload.get("ref") != f"refs/heads/{repository.get('default_branch')}":
+        return {"message": f"Ignored push to {payload.get('ref')}"}
+
+    refresher.enqueue(owner, repository["name"], repository.get("pushed_at"))
+    return {"message": f"Queued refresh of {repository['full_name']}"}
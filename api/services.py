@@ -1,33 +1,94 @@
 from db.models import (
+    DBCrawlRun,
+    DBPayload,
     DBTotalContributions,
     DBLanguageUsage,
     DBTotalLines,
     DBLastYearContributions,
 )
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm.exc import NoResultFound
 
 
-def get_db_last_year_contributions(db: Session) -> DBLastYearContributions:
-    contributions = db.query(DBLastYearContributions).all()
+async def get_latest_run_id(db: AsyncSession, username: str | None = None) -> int:
+    query = select(DBCrawlRun.id).where(DBCrawlRun.status == "completed")
+    if username is not None:
+        query = query.where(DBCrawlRun.username == username)
+
+    run_id = await db.scalar(query.order_by(DBCrawlRun.id.desc()).limit(1))
+    if run_id is None:
+        raise NoResultFound
+    return run_id
+
+
+async def get_db_last_year_contributions(
+    db: AsyncSession, username: str | None = None, run_id: int | None = None
+) -> list[DBLastYearContributions]:
+    if run_id is None:
+        run_id = await get_latest_run_id(db, username)
+    contributions = (
+        await db.scalars(
+            select(DBLastYearContributions).where(
+                DBLastYearContributions.run_id == run_id
+            )
+        )
+    ).all()
     if not contributions:
         raise NoResultFound
     return contributions
 
 
-def get_db_total_contributions(db: Session) -> DBTotalContributions:
-    contributions = db.query(DBTotalContributions).one()
+async def get_db_total_contributions(
+    db: AsyncSession, username: str | None = None, run_id: int | None = None
+) -> DBTotalContributions:
+    if run_id is None:
+        run_id = await get_latest_run_id(db, username)
+    contributions = (
+        await db.scalars(
+            select(DBTotalContributions).where(DBTotalContributions.run_id == run_id)
+        )
+    ).one()
     return contributions
 
 
-def get_db_language_usage(db: Session) -> list[DBLanguageUsage]:
-    language_usage = db.query(DBLanguageUsage).all()
+async def get_db_language_usage(
+    db: AsyncSession, username: str | None = None, run_id: int | None = None
+) -> list[DBLanguageUsage]:
+    if run_id is None:
+        run_id = await get_latest_run_id(db, username)
+    language_usage = (
+        await db.scalars(
+            select(DBLanguageUsage).where(DBLanguageUsage.run_id == run_id)
+        )
+    ).all()
     if not language_usage:
         raise NoResultFound
     return language_usage
 
 
-def get_db_total_lines(db: Session) -> DBTotalLines:
-    total_lines = db.query(DBTotalLines).one()
+async def get_db_total_lines(
+    db: AsyncSession, username: str | None = None, run_id: int | None = None
+) -> DBTotalLines:
+    if run_id is None:
+        run_id = await get_latest_run_id(db, username)
+    total_lines = (
+        await db.scalars(select(DBTotalLines).where(DBTotalLines.run_id == run_id))
+    ).one()
 
     return total_lines
+
+
+async def get_db_payload(db: AsyncSession, name: str, run_id: int) -> DBPayload | None:
+    return await db.get(DBPayload, (run_id, name))
+
+
+async def get_db_payloads(
+    db: AsyncSession, names: list[str], run_id: int
+) -> list[DBPayload]:
+    if not names:
+        return []
+    payloads = await db.scalars(
+        select(DBPayload).where(DBPayload.run_id == run_id, DBPayload.name.in_(names))
+    )
+    return payloads.all()
@@ -0,0 +1,211 @@
+import json
+import re
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PAGE_SIZE = 100
+PUSHED_AT = "2024-01-01T00:00:00Z"
+CREATED_AT = "2020-01-01T00:00:00Z"
+RATE_LIMIT_HEADERS = {"X-RateLimit-Remaining": "5000", "X-RateLimit-Reset": "0"}
+
+
+class FakeGitHub:
+    """Serves the REST and GraphQL calls made by the crawler from memory."""
+
+    def __init__(self, username, repos, latency=0.0, graphql_listing=True):
+        # repos maps each repository name to its language byte counts
+        self.username = username
+        self.repos = repos
+        self.latency = latency
+        self.graphql_listing = graphql_listing
+        self.pushed_at = dict.fromkeys(repos, PUSHED_AT)
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def push(self, repo, pushed_at):
+        self.pushed_at[repo] = pushed_at
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _rest_repo(self, name):
+        return {"name": name, "pushed_at": self.pushed_at[name], "size": 1}
+
+    def _graphql_repo(self, name):
+        return {
+            "name": name,
+            "pushedAt": self.pushed_at[name],
+            "diskUsage": 1,
+            "languages": {
+                "edges": [
+                    {"size": size, "node": {"name": language}}
+                    for language, size in self.repos[name].items()
+                ]
+            },
+        }
+
+    def list_repos(self, page):
+        names = list(self.repos)[(page - 1) * PAGE_SIZE : page * PAGE_SIZE]
+        has_next = page * PAGE_SIZE < len(self.repos)
+        return [self._rest_repo(name) for name in names], has_next
+
+    def graphql(self, query, variables):
+        if "repositories(" in query:
+            if not self.graphql_listing:
+                return {"errors": [{"message": "Listing disabled"}]}
+
+            start = int(variables.get("cursor") or 0)
+            names = list(self.repos)[start : start + PAGE_SIZE]
+            end = start + len(names)
+            return {
+                "data": {
+                    "user": {
+                        "repositories": {
+                            "pageInfo": {
+                                "hasNextPage": end < len(self.repos),
+                                "endCursor": str(end),
+                            },
+                            "nodes": [self._graphql_repo(name) for name in names],
+                        }
+                    }
+                }
+            }
+
+        if "createdAt" in query:
+            return {"data": {"user": {"createdAt": CREATED_AT}}}
+
+        if "weeks" in query:
+            return {"data": {"user": {"contributionsCollection": calendar()}}}
+
+        years = re.findall(r"y(\d{4}):", query)
+        return {
+            "data": {
+                "user": {
+                    f"y{year}": {
+                        "restrictedContributionsCount": 1,
+                        "contributionCalendar": {"totalContributions": 100},
+                    }
+                    for year in years
+                }
+            }
+        }
+
+    def _handler(self):
+        github = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, body, headers=None):
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                for name, value in {**RATE_LIMIT_HEADERS, **(headers or {})}.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def _delay(self):
+                with github.lock:
+                    github.requests += 1
+                if github.latency:
+                    time.sleep(github.latency)
+
+            def do_GET(self):
+                self._delay()
+                url = urlparse(self.path)
+                parts = url.path.strip("/").split("/")
+
+                if parts[:1] == ["users"] and parts[2:] == ["repos"]:
+                    page = int(parse_qs(url.query).get("page", ["1"])[0])
+                    repos, has_next = github.list_repos(page)
+                    headers = {}
+                    if has_next:
+                        next_url = (
+                            f"{github.url}{url.path}?per_page=100&page={page + 1}"
+                        )
+                        headers["Link"] = f'<{next_url}>; rel="next"'
+                    self._reply(200, repos, headers)
+                    return
+
+                if parts[:1] == ["repos"] and parts[3:] == ["languages"]:
+                    languages = github.repos.get(parts[2])
+                    if languages is None:
+                        self._reply(404, {"message": "Not Found"})
+                        return
+                    self._reply(200, languages)
+                    return
+
+                self._reply(404, {"message": "Not Found"})
+
+            def do_POST(self):
+                self._delay()
+                if self.path != "/graphql":
+                    self._reply(404, {"message": "Not Found"})
+                    return
+
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length))
+                self._reply(
+                    200,
+                    github.graphql(payload["query"], payload.get("variables") or {}),
+                )
+
+        return Handler
+
+
+def calendar(today=None):
+    today = today or date.today()
+    first_day = today - timedelta(days=364)
+    weeks = []
+    for week in range(53):
+        days = []
+        for weekday in range(7):
+            day = first_day + timedelta(days=week * 7 + weekday)
+            if day > today:
+                break
+            count = (week + weekday) % 5
+            days.append(
+                {
+                    "date": day.isoformat(),
+                    "contributionLevel": "FIRST_QUARTILE" if count else "NONE",
+                    "contributionCount": count,
+                }
+            )
+        if days:
+            weeks.append({"firstDay": days[0]["date"], "contributionDays": days})
+
+    return {
+        "contributionCalendar": {
+            "totalContributions": sum(
+                day["contributionCount"]
+                for week in weeks
+                for day in week["contributionDays"]
+            ),
+            "weeks": weeks,
+        }
+    }
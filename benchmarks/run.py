@@ -0,0 +1,216 @@
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+from contextlib import contextmanager
+
+# The crawler creates the app's engine on import, point it away from a real DB
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import Session, sessionmaker  # noqa: E402
+from benchmarks.fake_github import FakeGitHub  # noqa: E402
+from benchmarks.synthetic import make_repos, push  # noqa: E402
+from crawler.blobs import BlobLineCache  # noqa: E402
+from crawler.crawler import Crawler, get_logger  # noqa: E402
+from crawler.http_cache import HTTPCache  # noqa: E402
+from crawler.store import JSONStore  # noqa: E402
+from db.core import Base  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baselines.json")
+USERNAME = "bench"
+# A stage regresses when it is this much slower than its baseline
+TOLERANCE = 0.5
+# Stages faster than this are dominated by noise
+MIN_SLACK = 0.1
+SCENARIOS = ["cold", "warm", "incremental"]
+
+
+@contextmanager
+def chdir(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def make_crawler(db, github, origin, config):
+    return Crawler(
+        username=USERNAME,
+        token="bench",
+        db=db,
+        http_cache=HTTPCache("./cache/http_cache.json"),
+        line_counts=JSONStore("./cache/line_counts.json"),
+        language_counts=JSONStore("./cache/language_counts.json"),
+        blob_cache=BlobLineCache("./cache/blob_lines.json"),
+        workers=config["workers"],
+        object_store=config["object_store"],
+        start_year=None,
+        api_url=github.url,
+        clone_url=f"file://{origin}",
+    )
+
+
+def run_stages(db, github, origin, config):
+    crawler = make_crawler(db, github, origin, config)
+    try:
+        crawler.run()
+        report = crawler.metrics.report()
+    finally:
+        crawler.requester.close()
+
+    return {
+        stage: counters["wall_seconds"] for stage, counters in report["stages"].items()
+    }
+
+
+def run_round(root, round_number, github, origin, config):
+    workdir = os.path.join(root, f"round{round_number}")
+    os.makedirs(workdir)
+    engine = create_engine(f"sqlite:///{workdir}/bench.db")
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(class_=Session, autoflush=False, bind=engine)
+
+    results = {}
+    with chdir(workdir), session_factory() as db:
+        results["cold"] = run_stages(db, github, origin, config)
+        results["warm"] = run_stages(db, github, origin, config)
+
+        changed = max(1, config["repos"] // 10)
+        for i, repo in enumerate(list(github.repos)[:changed]):
+            push(
+                os.path.join(origin, USERNAME, repo),
+                config["files"] // 4 or 1,
+                config["lines"],
+                offset=round_number * 1000 + i + 1,
+            )
+            github.push(repo, f"2024-02-{round_number + 1:02d}T00:00:00Z")
+        results["incremental"] = run_stages(db, github, origin, config)
+
+    engine.dispose()
+    return results
+
+
+def median_results(rounds):
+    results = {}
+    for scenario in SCENARIOS:
+        stages = {stage for result in rounds for stage in result[scenario]}
+        results[scenario] = {
+            stage: statistics.median(
+                result[scenario].get(stage, 0) for result in rounds
+            )
+            for stage in sorted(stages)
+        }
+    return results
+
+
+def benchmark(config):
+    with tempfile.TemporaryDirectory() as root:
+        origin = os.path.join(root, "origin")
+        languages = make_repos(
+            origin, USERNAME, config["repos"], config["files"], config["lines"]
+        )
+        with FakeGitHub(
+            USERNAME,
+            languages,
+            latency=config["latency"],
+            graphql_listing=not config["rest"],
+        ) as github:
+            rounds = [
+                run_round(root, i, github, origin, config)
+                for i in range(config["rounds"])
+            ]
+
+    return median_results(rounds)
+
+
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for scenario, stages in baseline["results"].items():
+        for stage, expected in stages.items():
+            measured = results.get(scenario, {}).get(stage)
+            if measured is None:
+                continue
+
+            limit = expected * (1 + tolerance) + MIN_SLACK
+            if measured > limit:
+                regressions.append(
+                    f"{scenario}/{stage}: {measured:.3f}s, baseline {expected:.3f}s"
+                )
+    return regressions
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Times every crawler stage against a local fake GitHub."
+    )
+    parser.add_argument("--repos", type=int, default=20)
+    parser.add_argument("--files", type=int, default=40)
+    parser.add_argument("--lines", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--object-store", action="store_true")
+    parser.add_argument("--rest", action="store_true", help="list repos over REST")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_args(args)
+    config = {
+        "repos": options.repos,
+        "files": options.files,
+        "lines": options.lines,
+        "latency": options.latency,
+        "rounds": options.rounds,
+        "workers": options.workers,
+        "object_store": options.object_store,
+        "rest": options.rest,
+    }
+    get_logger().setLevel(logging.WARNING)
+
+    results = benchmark(config)
+    for scenario, stages in results.items():
+        for stage, seconds in stages.items():
+            print(f"{scenario:<12} {stage:<24} {seconds:8.3f}s")
+
+    report = {"config": config, "results": results}
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if options.update_baseline:
+        with open(options.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"Baseline written to {options.baseline}")
+        return 0
+
+    if not os.path.exists(options.baseline):
+        print(f"No baseline at {options.baseline}, run with --update-baseline")
+        return 1
+
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+
+    if baseline["config"] != config:
+        print("The baseline was recorded with other parameters, not comparing")
+        return 1
+
+    regressions = find_regressions(results, baseline, options.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
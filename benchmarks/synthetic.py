@@ -0,0 +1,57 @@
+import os
+import subprocess
+
+# Extensions cycled through the generated files, the last one is not counted
+EXTENSIONS = {".py": "Python", ".js": "JavaScript", ".go": "Go", ".txt": None}
+
+
+def git(repo_path, *args):
+    subprocess.run(
+        ["git", "-C", repo_path, "-c", "user.name=bench", "-c", "user.email=bench"]
+        + list(args),
+        check=True,
+        capture_output=True,
+    )
+
+
+def write_files(repo_path, files, lines, offset=0):
+    """Writes files spread over a few directories and returns the byte count per language."""
+    languages = {}
+    extensions = list(EXTENSIONS)
+    for i in range(files):
+        extension = extensions[i % len(extensions)]
+        directory = os.path.join(repo_path, f"pkg{i % 8}")
+        os.makedirs(directory, exist_ok=True)
+
+        content = "".join(f"value_{offset}_{line} = {line}\n" for line in range(lines))
+        with open(os.path.join(directory, f"file{i}{extension}"), "w") as f:
+            f.write(content)
+
+        language = EXTENSIONS[extension]
+        if language is not None:
+            languages[language] = languages.get(language, 0) + len(content)
+
+    return languages
+
+
+def make_repo(repo_path, files, lines):
+    os.makedirs(repo_path, exist_ok=True)
+    git(repo_path, "init", "-q", "-b", "main")
+    languages = write_files(repo_path, files, lines)
+    git(repo_path, "add", ".")
+    git(repo_path, "commit", "-q", "-m", "initial")
+    return languages
+
+
+def make_repos(root, username, count, files, lines):
+    """Creates count repositories under root/username and returns their languages."""
+    return {
+        f"repo{i}": make_repo(os.path.join(root, username, f"repo{i}"), files, lines)
+        for i in range(count)
+    }
+
+
+def push(repo_path, files, lines, offset):
+    """Rewrites the first files of a repository in a new commit."""
+    write_files(repo_path, files, lines, offset)
+    git(repo_path, "commit", "-q", "-am", f"change {offset}")
@@ -0,0 +1,87 @@
+import subprocess
+from crawler.lines import count_stream_lines
+from crawler.store import JSONStore
+
+BLOB_CACHE_SIZE = 100_000
+
+
+def list_blobs(repo_path, extensions, rev="HEAD"):
+    result = subprocess.run(
+        ["git", "-C", repo_path, "ls-tree", "-r", "-z", rev],
+        capture_output=True,
+        check=True,
+    )
+
+    blobs = []
+    for record in result.stdout.split(b"\0"):
+        if not record:
+            continue
+
+        info, path = record.split(b"\t", 1)
+        mode, object_type, sha = info.split()
+        # Symlink blobs hold the link target, not file contents
+        if object_type != b"blob" or mode == b"120000":
+            continue
+
+        path = path.decode("utf-8", errors="replace")
+        if path.rsplit("/", 1)[-1].endswith(extensions):
+            blobs.append((sha.decode(), path))
+
+    return blobs
+
+
+class BlobReader:
+    def __init__(self, repo_path: str):
+        self.process = subprocess.Popen(
+            ["git", "-C", repo_path, "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.bytes_read = 0
+
+    def count_lines(self, sha):
+        self.process.stdin.write(f"{sha}\n".encode())
+        self.process.stdin.flush()
+
+        header = self.process.stdout.readline().split()
+        if len(header) != 3:
+            raise KeyError(f"Blob {sha} not found")
+
+        size = int(header[2])
+        self.bytes_read += size
+        lines = count_stream_lines(self.process.stdout, size)
+        self.process.stdout.read(1)
+        return lines
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+        self.process.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BlobLineCache(JSONStore):
+    def __init__(self, path: str, max_size: int = BLOB_CACHE_SIZE):
+        super().__init__(path)
+        self.max_size = max_size
+
+    def get(self, sha, default=None):
+        with self.lock:
+            if sha not in self.data:
+                return default
+
+            # Re-insert so that dict order doubles as least-recently-used order
+            self.data[sha] = self.data.pop(sha)
+            return self.data[sha]
+
+    def set(self, sha, lines):
+        with self.lock:
+            self.data.pop(sha, None)
+            self.data[sha] = lines
+            while len(self.data) > self.max_size:
+                del self.data[next(iter(self.data))]
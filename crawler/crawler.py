@@ -1,16 +1,37 @@
+import json
 import requests
 import dotenv
 import os
+import signal
 import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import logging
+from queue import Empty, Queue
+from threading import Lock, Thread
 from datetime import datetime
-from db.core import get_db
+from db.core import get_db, session_local
+from crawler.daemon import JITTER, STAGE_INTERVALS, Daemon, crawl_lock
+from crawler.http_cache import HTTPCache
+from crawler.requester import (
+    CONNECT_TIMEOUT,
+    READ_TIMEOUT,
+    Requester,
+)
+from crawler.store import JSONStore
+from crawler.lines import batched, count_file_lines, count_files, file_size
+from crawler.metrics import RunMetrics, write_prometheus
+from crawler.blobs import BlobLineCache, BlobReader, list_blobs
+from db.payloads import PAYLOAD_NAMES, encode_rows
 from db.models import (
+    DBCrawlRun,
+    DBPayload,
     DBTotalContributions,
     DBLanguageUsage,
     DBTotalLines,
     DBLastYearContributions,
 )
+from sqlalchemy import delete, insert, literal, or_, select
 from sqlalchemy.orm import Session
 
 ACCEPTABLE_EXTENSIONS = acceptable_extensions = [
@@ -45,48 +66,398 @@ ACCEPTABLE_EXTENSIONS = acceptable_extensions = [
     ".sh",
 ]
 
+GITHUB_API_URL = "https://api.github.com"
+GITHUB_URL = "https://github.com"
+LANGUAGE_FETCH_CONCURRENCY = 8
+HTTP_CACHE_PATH = "./cache/http_cache.json"
+LINE_COUNTS_PATH = "./cache/line_counts.json"
+BLOB_CACHE_PATH = "./cache/blob_lines.json"
+LANGUAGE_COUNTS_PATH = "./cache/language_counts.json"
+LINE_COUNT_WORKERS = 1
+GIT_CONCURRENCY = 4
+LINE_COUNT_BATCH_SIZE = 256
+RUNS_TO_KEEP = 24
+USER_WORKERS = 4
+STAGES = [
+    "last_year_contributions",
+    "total_contributions",
+    "language_usage",
+    "total_lines",
+]
+# Stages that need the repository listing from get_repos
+REPO_STAGES = {"language_usage", "total_lines"}
+REPORT_LOCK = Lock()
+SNAPSHOT_MODELS = [
+    DBLastYearContributions,
+    DBTotalContributions,
+    DBLanguageUsage,
+    DBTotalLines,
+]
+
+
+def get_logger():
+    logger = logging.getLogger("CrawlerLogger")
+    if not logger.handlers:
+        logger.setLevel(logging.INFO)
+
+        handler = logging.StreamHandler()
+
+        formatter = logging.Formatter(
+            "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+        )
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    return logger
+
 
 class Crawler:
-    def __init__(self, username: str, token: str, db: Session):
+    def __init__(
+        self,
+        username: str,
+        token: str,
+        db: Session,
+        concurrency: int = LANGUAGE_FETCH_CONCURRENCY,
+        http_cache: HTTPCache | None = None,
+        start_year: int | None = None,
+        line_counts: JSONStore | None = None,
+        workers: int = LINE_COUNT_WORKERS,
+        object_store: bool = False,
+        blob_cache: BlobLineCache | None = None,
+        language_counts: JSONStore | None = None,
+        git_concurrency: int = GIT_CONCURRENCY,
+        pool_size: int | None = None,
+        timeout: tuple[float, float] = (CONNECT_TIMEOUT, READ_TIMEOUT),
+        requester: Requester | None = None,
+        pool: ProcessPoolExecutor | None = None,
+        run_reports: JSONStore | None = None,
+        metrics_path: str | None = None,
+        api_url: str = GITHUB_API_URL,
+        clone_url: str = GITHUB_URL,
+    ):
         self.username = username
         self.auth_header = {"Authorization": f"token {token}"}
         self.session = db
+        self.concurrency = concurrency
+        self.http_cache = http_cache
+        self.start_year = start_year
+        self.line_counts = line_counts
+        self.workers = workers
+        self.object_store = object_store
+        self.blob_cache = blob_cache
+        self.language_counts = language_counts
+        self.git_concurrency = git_concurrency
+        self.pool = pool
+        self.run_reports = run_reports
+        self.metrics_path = metrics_path
+        self.api_url = api_url
+        self.clone_url = clone_url
+        self.metrics = RunMetrics()
+        self.run_id = None
         self.repos = []
+        self.repo_metadata = {}
         self.total_lines = 0
 
-        self.logger = logging.getLogger("CrawlerLogger")
-        self.logger.setLevel(logging.INFO)
+        self.logger = get_logger().getChild(username or "default")
 
-        handler = logging.StreamHandler()
+        self.requester = requester or Requester(
+            pool_size=pool_size or concurrency,
+            timeout=timeout,
+            logger=self.logger,
+        )
 
-        formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
-        handler.setFormatter(formatter)
-        self.logger.addHandler(handler)
+    def _request(self, method, url, **kwargs):
+        response = self.requester.request(method, url, **kwargs)
+        self.metrics.add("http_requests", 1)
+        self.metrics.add("http_bytes", len(response.content or b""))
+        return response
 
-    def _fetch_repos(self):
-        response = requests.get(
-            f"https://api.github.com/users/{self.username}/repos",
+    def _get(self, url):
+        if self.http_cache is None:
+            return self._request("GET", url, headers=self.auth_header)
+
+        headers = {**self.auth_header, **self.http_cache.conditional_headers(url)}
+        response = self._request("GET", url, headers=headers)
+        return self.http_cache.resolve(url, response)
+
+    def _post_graphql(self, query, variables=None):
+        payload = {"query": query}
+        if variables:
+            payload["variables"] = variables
+
+        return self._request(
+            "POST",
+            f"{self.api_url}/graphql",
             headers=self.auth_header,
+            json=payload,
         )
-        if not response.ok:
-            self.logger.error("Failed to get repos")
-            raise requests.exceptions.RequestException(response.text)
 
-        return response.json()
+    def _save_stores(self, *stores):
+        for store in stores:
+            if store is None:
+                continue
+
+            try:
+                store.save()
+            except OSError as e:
+                self.logger.error(f"Failed to save {store.path}: {str(e)}")
+
+    def _fetch_repos(self):
+        repos = []
+        url = f"{self.api_url}/users/{self.username}/repos?per_page=100"
+        while url:
+            response = self._get(url)
+            if not response.ok:
+                self.logger.error("Failed to get repos")
+                raise requests.exceptions.RequestException(response.text)
+
+            repos.extend(response.json())
+            url = response.links.get("next", {}).get("url")
+
+        return repos
+
+    def _iter_repos(self):
+        query = """
+                query ($login: String!, $cursor: String) {
+                    user(login: $login) {
+                        repositories(
+                            first: 100
+                            after: $cursor
+                            ownerAffiliations: OWNER
+                            privacy: PUBLIC
+                        ) {
+                            pageInfo {
+                                hasNextPage
+                                endCursor
+                            }
+                            nodes {
+                                name
+                                pushedAt
+                                diskUsage
+                                languages(first: 100) {
+                                    edges {
+                                        size
+                                        node {
+                                            name
+                                        }
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+                """
+        cursor = None
+        while True:
+            response = self._post_graphql(
+                query, {"login": self.username, "cursor": cursor}
+            )
+            if not response.ok:
+                self.logger.error("Failed to get repos")
+                raise requests.exceptions.RequestException(response.text)
+
+            data = response.json()
+            if data.get("errors"):
+                raise requests.exceptions.RequestException(str(data["errors"]))
+
+            repositories = data["data"]["user"]["repositories"]
+            for node in repositories["nodes"]:
+                # Same keys as the REST listing, plus the language byte counts
+                yield {
+                    "name": node["name"],
+                    "pushed_at": node["pushedAt"],
+                    "size": node["diskUsage"],
+                    "languages": {
+                        edge["node"]["name"]: edge["size"]
+                        for edge in node["languages"]["edges"]
+                    },
+                }
+
+            if not repositories["pageInfo"]["hasNextPage"]:
+                return
+            cursor = repositories["pageInfo"]["endCursor"]
 
     def get_repos(self):
         try:
-            repos_dict = self._fetch_repos()
+            repos_dict = list(self._iter_repos())
 
         except requests.exceptions.RequestException as e:
-            self.logger.error(f"RequestException: {e}")
-            return
+            self.logger.error(f"GraphQL repository listing failed: {e}")
+            try:
+                repos_dict = self._fetch_repos()
+
+            except requests.exceptions.RequestException as e:
+                self.logger.error(f"RequestException: {e}")
+                return
 
-        for repo in repos_dict:
-            self.repos.append(repo["name"])
+        self.repos = [repo["name"] for repo in repos_dict]
+        self.repo_metadata = {repo["name"]: repo for repo in repos_dict}
+        self._forget_removed_repos()
 
+        self._save_stores(self.http_cache, self.language_counts, self.line_counts)
         self.logger.info("Successfully retrieved repos")
 
+    def _forget_removed_repos(self):
+        # Webhook refreshes rebuild the totals from the stores
+        for repo in set(self._stored_repos()) - set(self.repos):
+            for store in (self.language_counts, self.line_counts):
+                if store is not None:
+                    store.delete(self._repo_key(repo))
+
+    def start_run(self):
+        with self.session as session:
+            crawl_run = DBCrawlRun(username=self.username, status="running")
+            session.add(crawl_run)
+            session.commit()
+            self.run_id = crawl_run.id
+
+        self.logger.info(f"Started crawl run {self.run_id}")
+
+    def _carry_forward(self, session, previous_run_id):
+        # Stages that did not write in this run keep the previous run's data
+        for model in SNAPSHOT_MODELS:
+            written = session.scalar(
+                select(model.id).where(model.run_id == self.run_id).limit(1)
+            )
+            if written is not None:
+                continue
+
+            columns = [
+                column
+                for column in model.__table__.columns
+                if column.name not in ("id", "run_id")
+            ]
+            previous_rows = select(*columns, literal(self.run_id)).where(
+                model.run_id == previous_run_id
+            )
+            session.execute(
+                insert(model).from_select(
+                    [column.name for column in columns] + ["run_id"], previous_rows
+                )
+            )
+            self._carry_forward_payload(session, model, previous_run_id)
+
+    def _carry_forward_payload(self, session, model, previous_run_id):
+        # Copied byte for byte so that the API's validators stay unchanged
+        previous_payload = select(
+            literal(self.run_id),
+            DBPayload.name,
+            DBPayload.content,
+            DBPayload.gzip_content,
+            DBPayload.date_created,
+        ).where(
+            DBPayload.run_id == previous_run_id,
+            DBPayload.name == PAYLOAD_NAMES[model],
+        )
+        session.execute(
+            insert(DBPayload).from_select(
+                ["run_id", "name", "content", "gzip_content", "date_created"],
+                previous_payload,
+            )
+        )
+
+    def _latest_completed_run_id(self, session):
+        return session.scalar(
+            select(DBCrawlRun.id)
+            .where(
+                DBCrawlRun.username == self.username,
+                DBCrawlRun.status == "completed",
+            )
+            .order_by(DBCrawlRun.id.desc())
+            .limit(1)
+        )
+
+    def _prune_runs(self, session):
+        oldest_kept = session.scalar(
+            select(DBCrawlRun.id)
+            .where(
+                DBCrawlRun.username == self.username,
+                DBCrawlRun.status == "completed",
+            )
+            .order_by(DBCrawlRun.id.desc())
+            .offset(RUNS_TO_KEEP - 1)
+            .limit(1)
+        )
+        if oldest_kept is None:
+            return
+
+        stale_run_ids = select(DBCrawlRun.id).where(
+            DBCrawlRun.username == self.username, DBCrawlRun.id < oldest_kept
+        )
+        for model in SNAPSHOT_MODELS:
+            session.execute(
+                delete(model).where(
+                    or_(model.run_id.in_(stale_run_ids), model.run_id.is_(None))
+                )
+            )
+        session.execute(delete(DBPayload).where(DBPayload.run_id.in_(stale_run_ids)))
+        session.execute(delete(DBCrawlRun).where(DBCrawlRun.id.in_(stale_run_ids)))
+
+    def finish_run(self, status="completed"):
+        if self.run_id is None:
+            return
+
+        with self.metrics.timer("db_seconds"), self.session as session:
+            if status == "completed":
+                previous_run_id = self._latest_completed_run_id(session)
+                if previous_run_id is not None:
+                    self._carry_forward(session, previous_run_id)
+
+            crawl_run = session.get(DBCrawlRun, self.run_id)
+            crawl_run.status = status
+            crawl_run.finished_at = datetime.now()
+
+            if status == "completed":
+                session.flush()
+                self._prune_runs(session)
+            session.commit()
+
+        self.logger.info(f"Finished crawl run {self.run_id} with status {status}")
+        self.run_id = None
+
+    def _write_snapshot(self, model, rows):
+        if self.run_id is None:
+            self.start_run()
+
+        date_created = datetime.now()
+        rows = [
+            {**row, "run_id": self.run_id, "date_created": date_created} for row in rows
+        ]
+
+        # Readers only see completed runs, so rows of the running crawl are
+        # invisible until finish_run marks it completed
+        with self.metrics.timer("db_seconds"), self.session as session:
+            session.execute(delete(model).where(model.run_id == self.run_id))
+            if rows:
+                session.execute(insert(model), rows)
+            self._write_payload(session, model)
+            session.commit()
+
+    def _write_payload(self, session, model):
+        # The API serves this row verbatim instead of serializing the table
+        name = PAYLOAD_NAMES[model]
+        session.execute(
+            delete(DBPayload).where(
+                DBPayload.run_id == self.run_id, DBPayload.name == name
+            )
+        )
+        rows = session.scalars(
+            select(model).where(model.run_id == self.run_id).order_by(model.id)
+        ).all()
+        if not rows:
+            return
+
+        content, gzip_content = encode_rows(name, rows)
+        session.add(
+            DBPayload(
+                run_id=self.run_id,
+                name=name,
+                content=content,
+                gzip_content=gzip_content,
+                date_created=max(row.date_created for row in rows),
+            )
+        )
+
     def _fetch_last_year_contributions(self):
         query = f"""
                 query {{
@@ -108,11 +479,11 @@ class Crawler:
                     }}
                 }}
                 """
-        response = requests.post(
-            "https://api.github.com/graphql",
-            headers=self.auth_header,
-            json={"query": query},
-        )
+        response = self._post_graphql(query)
+        if not response.ok:
+            self.logger.error("Failed to get last year contributions")
+            raise requests.exceptions.RequestException(response.text)
+
         data = response.json()
         return data["data"]["user"]["contributionsCollection"]["contributionCalendar"]
 
@@ -152,48 +523,66 @@ class Crawler:
 
         self.logger.info("Successfully retrieved last years contributions")
 
-        with self.session as session:
-            session.query(DBLastYearContributions).delete()
-            for day in calendar:
-                last_year_contributions = DBLastYearContributions(
-                    date=day["date"], count=day["count"], level=day["level"]
-                )
-                session.add(last_year_contributions)
-            session.commit()
-            self.logger.info("Successfully saved last year contributions to database")
+        self._write_snapshot(DBLastYearContributions, calendar)
+        self.logger.info("Successfully saved last year contributions to database")
 
-    def _fetch_yearly_contributions(self, year):
+    def _fetch_start_year(self):
         query = f"""
-                    query {{
-                        user(login: "{self.username}") {{
-                            contributionsCollection(to: "{year}-12-31T00:00:00Z") {{
-                                restrictedContributionsCount
-                                contributionCalendar {{
-                                    totalContributions
-                                }}
+                query {{
+                    user(login: "{self.username}") {{
+                        createdAt
+                    }}
+                }}
+                """
+        response = self._post_graphql(query)
+        if not response.ok:
+            self.logger.error("Failed to get account creation date")
+            raise requests.exceptions.RequestException(response.text)
+
+        data = response.json()
+        created_at = data["data"]["user"]["createdAt"]
+        return datetime.strptime(created_at, "%Y-%m-%dT%H:%M:%SZ").year
+
+    def _build_contributions_query(self, years):
+        collections = "".join(f"""
+                        y{year}: contributionsCollection(to: "{year}-12-31T00:00:00Z") {{
+                            restrictedContributionsCount
+                            contributionCalendar {{
+                                totalContributions
                             }}
-                        }}
+                        }}""" for year in years)
+        return f"""
+                query {{
+                    user(login: "{self.username}") {{{collections}
                     }}
-                    """
-        response = requests.post(
-            "https://api.github.com/graphql",
-            headers=self.auth_header,
-            json={"query": query},
-        )
+                }}
+                """
+
+    def _fetch_contributions_by_year(self, years):
+        query = self._build_contributions_query(years)
+        response = self._post_graphql(query)
+        if not response.ok:
+            self.logger.error("Failed to get contributions")
+            raise requests.exceptions.RequestException(response.text)
+
         data = response.json()
-        return data["data"]["user"]["contributionsCollection"]
+        user = data["data"]["user"]
+        return {year: user[f"y{year}"] for year in years}
 
     def get_total_contributions(self):
-        contributions = 0
-        this_year = datetime.now().year
-        for year in range(2022, this_year + 1):
-            try:
-                contributions_collection = self._fetch_yearly_contributions(year)
+        try:
+            if self.start_year is None:
+                self.start_year = self._fetch_start_year()
 
-            except requests.exceptions.RequestException as e:
-                self.logger.error(f"RequestException: {str(e)}")
-                continue
+            years = range(self.start_year, datetime.now().year + 1)
+            contributions_by_year = self._fetch_contributions_by_year(years)
+
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f"RequestException: {str(e)}")
+            return
 
+        contributions = 0
+        for year, contributions_collection in contributions_by_year.items():
             contributions += contributions_collection["contributionCalendar"][
                 "totalContributions"
             ]
@@ -206,26 +595,46 @@ class Crawler:
             self.logger.error("No contributions found")
             return
 
-        with self.session as session:
-            session.query(DBTotalContributions).delete()
-            total_contributions = DBTotalContributions(
-                total_contributions=contributions
-            )
-            session.add(total_contributions)
-            session.commit()
-            self.logger.info("Successfully saved total contributions to database")
+        self._write_snapshot(
+            DBTotalContributions, [{"total_contributions": contributions}]
+        )
+        self.logger.info("Successfully saved total contributions to database")
 
     def _get_repo_languages(self, repo):
-        response = requests.get(
-            f"https://api.github.com/repos/{self.username}/{repo}/languages",
-            headers=self.auth_header,
-        )
+        response = self._get(f"{self.api_url}/repos/{self.username}/{repo}/languages")
         if not response.ok:
             self.logger.error(f"Failed to get languages for repository {repo}")
             return
 
         return response.json()
 
+    def _record_languages(self, repo, repo_languages):
+        if self.language_counts is None:
+            return
+
+        self.language_counts.set(
+            self._repo_key(repo),
+            {"pushed_at": self._pushed_at(repo), "languages": repo_languages},
+        )
+
+    def _repo_key(self, repo):
+        return f"{self.username}/{repo}"
+
+    def _pushed_at(self, repo):
+        return self.repo_metadata.get(repo, {}).get("pushed_at")
+
+    def _is_unchanged(self, store, repo):
+        if store is None:
+            return False
+
+        pushed_at = self._pushed_at(repo)
+        counted = store.get(self._repo_key(repo))
+        return (
+            pushed_at is not None
+            and counted is not None
+            and counted.get("pushed_at") == pushed_at
+        )
+
     def _parse_languages(self, languages, repo_languages):
         for language, bytes in repo_languages.items():
             if language in languages:
@@ -235,105 +644,632 @@ class Crawler:
 
         return languages
 
+    def _fetch_languages(self, repos):
+        languages = {}
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        with executor:
+            futures = {
+                executor.submit(self._get_repo_languages, repo): i for i, repo in repos
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    repo_languages = future.result()
+                except requests.exceptions.RequestException as e:
+                    self.logger.error(f"RequestException: {str(e)}")
+                    continue
+
+                if repo_languages is None:
+                    continue
+
+                self._record_languages(self.repos[i], repo_languages)
+                languages = self._parse_languages(languages, repo_languages)
+
+                self.logger.info(f"Successfully retrieved languages for repository {i}")
+
+        return languages
+
     def get_language_usage(self):
         if not self.repos:
             self.logger.error("No repos found")
             return
 
         languages = {}
-
+        changed = []
         for i, repo in enumerate(self.repos):
-            try:
-                repo_languages = self._get_repo_languages(repo)
+            listed = self.repo_metadata.get(repo, {}).get("languages")
+            if self._is_unchanged(self.language_counts, repo):
+                counted = self.language_counts.get(self._repo_key(repo))
+                languages = self._parse_languages(languages, counted["languages"])
+            elif listed is not None:
+                self._record_languages(repo, listed)
+                languages = self._parse_languages(languages, listed)
+            else:
+                changed.append((i, repo))
 
-            except requests.exceptions.RequestException as e:
-                self.logger.error(f"RequestException: {str(e)}")
-                continue
+        self.logger.info(f"Fetching languages for {len(changed)} changed repositories")
+        fetched = self._fetch_languages(changed)
+        languages = self._parse_languages(languages, fetched)
+        self._save_stores(self.http_cache, self.language_counts)
 
-            languages = self._parse_languages(languages, repo_languages)
+        self.logger.info("Successfully retrieved languages")
 
-            self.logger.info(f"Successfully retrieved languages for repository {i}")
+        self._write_snapshot(
+            DBLanguageUsage,
+            [
+                {"language": language, "count": count}
+                for language, count in languages.items()
+            ],
+        )
+        self.logger.info("Successfully saved languages to database")
 
-        self.logger.info("Successfully retrieved languages")
+    def _repo_path(self, repo):
+        if self.object_store:
+            return f"./repos/{self.username}/{repo}.git"
 
-        with self.session as session:
-            session.query(DBLanguageUsage).delete()
+        return f"./repos/{self.username}/{repo}"
 
-            for language, count in languages.items():
-                language_usage = DBLanguageUsage(language=language, count=count)
-                session.add(language_usage)
-            session.commit()
-            self.logger.info("Successfully saved languages to database")
+    def _clone_args(self):
+        # Incremental counting diffs against older commits, so it needs history
+        if self.line_counts is None:
+            return ["--depth", "1"]
+        if self.object_store:
+            return []
+        return ["--filter=blob:none"]
 
     def _clone_repo(self, repo, i):
-        repo_path = f"./repos/{repo}"
+        repo_path = self._repo_path(repo)
         self.logger.info(f"Cloning repository {i}")
+        command = ["git", "clone", *self._clone_args()]
+        if self.object_store:
+            command.append("--bare")
         subprocess.run(
-            [
-                "git",
-                "clone",
-                f"https://github.com/{self.username}/{repo}",
-                repo_path,
-            ],
+            command + [f"{self.clone_url}/{self.username}/{repo}", repo_path],
             check=True,
         )
 
     def _pull_repo(self, repo_path):
         self.logger.info("Pulling latest changes")
+        shallow = self.line_counts is None
+        if self.object_store:
+            subprocess.run(
+                [
+                    "git",
+                    "-C",
+                    repo_path,
+                    "fetch",
+                    "--prune",
+                    *(["--depth", "1"] if shallow else []),
+                    "origin",
+                    "+refs/heads/*:refs/heads/*",
+                ],
+                check=True,
+            )
+            return
+
+        if shallow:
+            subprocess.run(
+                ["git", "-C", repo_path, "fetch", "--depth", "1", "origin", "HEAD"],
+                check=True,
+            )
+            subprocess.run(
+                ["git", "-C", repo_path, "reset", "--hard", "FETCH_HEAD"], check=True
+            )
+            return
+
         subprocess.run(["git", "-C", repo_path, "pull"], check=True)
 
+    def _sync_repo(self, repo, i):
+        start = time.perf_counter()
+        repo_path = self._repo_path(repo)
+        if not os.path.exists(repo_path):
+            self._clone_repo(repo, i)
+        else:
+            self._pull_repo(repo_path)
+
+        elapsed = time.perf_counter() - start
+        self.metrics.add("git_seconds", elapsed)
+        self.metrics.add_repo(repo, "sync_seconds", elapsed)
+        return elapsed
+
+    def _sync_repos(self, repos):
+        executor = ThreadPoolExecutor(max_workers=self.git_concurrency)
+        with executor:
+            futures = {
+                executor.submit(self._sync_repo, repo, i): (i, repo)
+                for i, repo in repos
+            }
+            for future in as_completed(futures):
+                i, repo = futures[future]
+                synced = True
+                try:
+                    elapsed = future.result()
+                    self.logger.info(f"Synced repository {i} in {elapsed:.2f}s")
+                except subprocess.CalledProcessError as e:
+                    self.logger.error(f"Failed to sync repository {i}: {str(e)}")
+                    if not os.path.exists(self._repo_path(repo)):
+                        continue
+                    synced = False
+
+                yield i, repo, synced
+
+    def _get_head_sha(self, repo_path):
+        with self.metrics.timer("git_seconds"):
+            result = subprocess.run(
+                ["git", "-C", repo_path, "rev-parse", "HEAD"],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+        return result.stdout.strip()
+
+    def _diff_lines(self, repo_path, old_sha, new_sha):
+        with self.metrics.timer("git_seconds"):
+            result = subprocess.run(
+                [
+                    "git",
+                    "-C",
+                    repo_path,
+                    "diff",
+                    "--numstat",
+                    "--no-renames",
+                    "-z",
+                    old_sha,
+                    new_sha,
+                ],
+                capture_output=True,
+                check=True,
+            )
+
+        delta = 0
+        for record in result.stdout.split(b"\0"):
+            if not record:
+                continue
+
+            added, deleted, path = record.decode("utf-8", errors="replace").split(
+                "\t", 2
+            )
+            if not path.endswith(tuple(ACCEPTABLE_EXTENSIONS)):
+                continue
+            # A counted file that is binary on either side has no line stats
+            if added == "-":
+                return None
+
+            delta += int(added) - int(deleted)
+
+        return delta
+
     def _count_lines(self, file_path):
-        with open(file_path, "r", encoding="utf-8") as f:
-            try:
-                self.total_lines += sum(1 for _ in f)
-            except Exception as e:
-                self.logger.error(f"Failed to read file {file_path}: {str(e)}")
+        try:
+            return count_file_lines(file_path)
+        except Exception as e:
+            self.logger.error(f"Failed to read file {file_path}: {str(e)}")
+            return 0
 
-    def _walk_files(self, repo):
-        for root, _, files in os.walk(f"./repos/{repo}"):
+    def _count_lines_parallel(self, file_paths):
+        counts = []
+        batches = batched(file_paths, LINE_COUNT_BATCH_SIZE)
+        for batch_counts, failed in self.pool.map(count_files, batches):
+            counts.extend(batch_counts)
+            for file_path, error in failed:
+                self.logger.error(f"Failed to read file {file_path}: {error}")
+
+        return counts
+
+    def _count_file_paths(self, file_paths):
+        self.metrics.add("files_scanned", len(file_paths))
+        self.metrics.add("bytes_scanned", sum(map(file_size, file_paths)))
+        if self.pool is not None:
+            return self._count_lines_parallel(file_paths)
+
+        return [self._count_lines(file_path) for file_path in file_paths]
+
+    def _list_files(self, repo):
+        file_paths = []
+        for root, _, files in os.walk(self._repo_path(repo)):
             for file in files:
                 if file.endswith(tuple(ACCEPTABLE_EXTENSIONS)):
-                    file_path = os.path.join(root, file)
-                    self._count_lines(file_path)
+                    file_paths.append(os.path.join(root, file))
+
+        return file_paths
+
+    def _walk_files(self, repo):
+        return sum(self._count_file_paths(self._list_files(repo)))
+
+    def _count_blobs(self, repo):
+        repo_path = self._repo_path(repo)
+        try:
+            with self.metrics.timer("git_seconds"):
+                blobs = list_blobs(repo_path, tuple(ACCEPTABLE_EXTENSIONS))
+        except subprocess.CalledProcessError as e:
+            # An empty repository has no HEAD and no lines
+            self.logger.error(f"Failed to list files of {repo}: {str(e)}")
+            return 0
+
+        lines = 0
+        uncached = []
+        for sha, path in blobs:
+            cached = None
+            if self.blob_cache is not None:
+                cached = self.blob_cache.get(sha)
+
+            if cached is None:
+                uncached.append((sha, path))
+            else:
+                lines += cached
+
+        if self.object_store:
+            counts = self._read_blobs(repo_path, uncached)
+        else:
+            file_paths = [os.path.join(repo_path, path) for _, path in uncached]
+            counts = self._count_file_paths(file_paths)
+
+        for (sha, _), count in zip(uncached, counts):
+            if self.blob_cache is not None:
+                self.blob_cache.set(sha, count)
+            lines += count
+
+        return lines
+
+    def _read_blobs(self, repo_path, blobs):
+        counts = []
+        with BlobReader(repo_path) as reader:
+            for sha, path in blobs:
+                try:
+                    counts.append(reader.count_lines(sha))
+                except KeyError as e:
+                    self.logger.error(f"Failed to read blob {path}: {str(e)}")
+                    counts.append(0)
+
+        self.metrics.add("files_scanned", len(blobs))
+        self.metrics.add("bytes_scanned", reader.bytes_read)
+        return counts
+
+    def _count_all_lines(self, repo):
+        if self.object_store or self.blob_cache is not None:
+            return self._count_blobs(repo)
+
+        return self._walk_files(repo)
+
+    def _count_repo_lines(self, repo, synced=True):
+        if self.line_counts is None:
+            return self._count_all_lines(repo)
+
+        repo_path = self._repo_path(repo)
+        try:
+            head_sha = self._get_head_sha(repo_path)
+        except subprocess.CalledProcessError as e:
+            self.logger.error(f"Failed to resolve HEAD for {repo}: {str(e)}")
+            return self._count_all_lines(repo)
+
+        counted = self.line_counts.get(self._repo_key(repo))
+        # A stale clone keeps the old pushed_at, so the next crawl syncs it again
+        pushed_at = self._pushed_at(repo)
+        if not synced:
+            pushed_at = counted["pushed_at"] if counted is not None else None
+
+        if counted is not None and counted["sha"] == head_sha:
+            self.line_counts.set(
+                self._repo_key(repo), {**counted, "pushed_at": pushed_at}
+            )
+            return counted["lines"]
+
+        lines = None
+        if counted is not None:
+            try:
+                delta = self._diff_lines(repo_path, counted["sha"], head_sha)
+                if delta is None:
+                    self.logger.info(f"Binary change in {repo}, recounting")
+                else:
+                    lines = counted["lines"] + delta
+            except subprocess.CalledProcessError as e:
+                self.logger.error(f"Failed to diff {repo}, recounting: {str(e)}")
+
+        if lines is None:
+            lines = self._count_all_lines(repo)
+
+        self.line_counts.set(
+            self._repo_key(repo),
+            {"sha": head_sha, "lines": lines, "pushed_at": pushed_at},
+        )
+        return lines
 
     def get_total_lines(self):
+        self.total_lines = 0
+
+        owns_pool = self.pool is None and self.workers > 1
+        if owns_pool:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            # Fork the workers now, before the git sync threads are started
+            self.pool.submit(int).result()
+
+        changed = []
         for i, repo in enumerate(self.repos):
-            repo_path = f"./repos/{repo}"
-            if not os.path.exists(repo_path):
-                self._clone_repo(repo, i)
+            if self._is_unchanged(self.line_counts, repo):
+                self.total_lines += self.line_counts.get(self._repo_key(repo))["lines"]
+                self.logger.info(f"Repository {i} unchanged since last crawl")
             else:
-                self._pull_repo(repo_path)
+                changed.append((i, repo))
+
+        try:
+            # Repositories are counted as soon as their sync finishes
+            for i, repo, synced in self._sync_repos(changed):
+                start = time.perf_counter()
+                self.total_lines += self._count_repo_lines(repo, synced)
+                self.metrics.add_repo(
+                    repo, "count_seconds", time.perf_counter() - start
+                )
 
-            self._walk_files(repo)
+                self.logger.info(f"Successfully counted total lines for repository {i}")
+        finally:
+            if owns_pool:
+                self.pool.shutdown()
+                self.pool = None
 
-            self.logger.info(f"Successfully counted total lines for repository {i}")
+        self._save_stores(self.line_counts, self.blob_cache)
 
         if self.total_lines == 0:
             self.logger.error("No lines found")
             return
 
-        with self.session as session:
-            session.query(DBTotalLines).delete()
-            total_lines = DBTotalLines(total_lines=self.total_lines)
-            session.add(total_lines)
-            session.commit()
-            self.logger.info("Successfully saved total lines to database")
+        self._write_snapshot(DBTotalLines, [{"total_lines": self.total_lines}])
+        self.logger.info("Successfully saved total lines to database")
+
+    def _report_run(self, run_id, status):
+        report = self.metrics.report(
+            username=self.username,
+            run_id=run_id,
+            status=status,
+            finished_at=datetime.now().isoformat(),
+        )
+        self.logger.info(f"Run report: {json.dumps(report)}")
 
-    def run(self):
+        # Users finishing together write in turn, so the last file has every report
+        with REPORT_LOCK:
+            reports = [report]
+            if self.run_reports is not None:
+                self.run_reports.set(self.username, report)
+                self._save_stores(self.run_reports)
+                reports = [self.run_reports.get(key) for key in self.run_reports.keys()]
+
+            if self.metrics_path is not None:
+                try:
+                    write_prometheus(self.metrics_path, reports)
+                except OSError as e:
+                    self.logger.error(f"Failed to write {self.metrics_path}: {str(e)}")
+
+        return report
+
+    def _run_stages(self, stages):
+        self.metrics = RunMetrics()
+        self.start_run()
+        run_id = self.run_id
+        try:
+            # Stages left out keep the previous run's data through finish_run
+            for stage in stages:
+                with self.metrics.stage(stage):
+                    getattr(self, f"get_{stage}")()
+        except Exception:
+            with self.metrics.stage("finish"):
+                self.finish_run("failed")
+            self._report_run(run_id, "failed")
+            raise
+
+        with self.metrics.stage("finish"):
+            self.finish_run()
+        self._report_run(run_id, "completed")
+
+    def run(self, stages=STAGES):
         self.logger.info("Starting crawler")
-        self.get_repos()
-        self.get_last_year_contributions()
-        self.get_total_contributions()
-        self.get_language_usage()
-        self.get_total_lines()
+        stages = [stage for stage in STAGES if stage in stages]
+        if REPO_STAGES.intersection(stages):
+            stages = ["repos"] + stages
+
+        self._run_stages(stages)
         self.logger.info("Crawler finished")
 
+    def _stored_repos(self):
+        prefix = f"{self.username}/"
+        stored = {}
+        for store in (self.language_counts, self.line_counts):
+            if store is None:
+                continue
+
+            for key in store.keys():
+                if key.startswith(prefix):
+                    repo = key[len(prefix) :]
+                    stored[repo] = store.get(key).get("pushed_at")
+        return stored
 
-if __name__ == "__main__":
+    def refresh_repos(self, pushed):
+        """Recounts the pushed repos and reuses the stored counts of the rest."""
+        stored = {}
+        if self.language_counts is not None and self.line_counts is not None:
+            stored = self._stored_repos()
+        if not stored:
+            # Without the crawler's stores a refresh would clone and count every repo
+            self.logger.error("No stored repository counts, skipping the refresh")
+            return
+
+        self.logger.info(f"Refreshing {len(pushed)} pushed repositories")
+        repo_metadata = {**stored, **pushed}
+        self.repos = list(repo_metadata)
+        self.repo_metadata = {
+            repo: {"name": repo, "pushed_at": pushed_at}
+            for repo, pushed_at in repo_metadata.items()
+        }
+        self._run_stages([stage for stage in STAGES if stage in REPO_STAGES])
+
+
+def crawl_users(
+    usernames,
+    token,
+    session_factory,
+    user_workers=USER_WORKERS,
+    stages=STAGES,
+    requester=None,
+    pool=None,
+    **options,
+):
+    logger = get_logger()
+    users = Queue()
+    for username in usernames:
+        users.put(username)
+
+    # All users share the token's rate limit, its connections and one process pool
+    owns_requester = requester is None
+    pool_size = options.pop("pool_size", None)
+    timeout = options.pop("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    if owns_requester:
+        requester = Requester(
+            pool_size=pool_size or shared_pool_size(user_workers, options),
+            timeout=timeout,
+            logger=logger,
+        )
+    owns_pool = pool is None and options.get("workers", LINE_COUNT_WORKERS) > 1
+    if owns_pool:
+        pool = ProcessPoolExecutor(max_workers=options["workers"])
+        pool.submit(int).result()
+
+    def work():
+        while True:
+            try:
+                username = users.get_nowait()
+            except Empty:
+                return
+
+            db = session_factory()
+            try:
+                crawler = Crawler(
+                    username=username,
+                    token=token,
+                    db=db,
+                    requester=requester,
+                    pool=pool,
+                    **options,
+                )
+                crawler.run(stages)
+            except Exception as e:
+                logger.error(f"Crawling {username} failed: {str(e)}")
+            finally:
+                db.close()
+
+    threads = [Thread(target=work) for _ in range(min(user_workers, len(usernames)))]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if owns_pool:
+            pool.shutdown()
+        if owns_requester:
+            requester.close()
+
+
+def shared_pool_size(user_workers, options):
+    # Every user's crawler may fetch languages with its full concurrency at once
+    return user_workers * options.get("concurrency", LANGUAGE_FETCH_CONCURRENCY)
+
+
+def options_from_env():
+    start_year = os.getenv("CONTRIBUTIONS_START_YEAR")
+    pool_size = os.getenv("HTTP_POOL_SIZE")
+    run_reports_path = os.getenv("RUN_REPORTS_PATH")
+    return {
+        "concurrency": int(
+            os.getenv("CRAWLER_CONCURRENCY", LANGUAGE_FETCH_CONCURRENCY)
+        ),
+        "http_cache": HTTPCache(os.getenv("HTTP_CACHE_PATH", HTTP_CACHE_PATH)),
+        "start_year": int(start_year) if start_year else None,
+        "line_counts": JSONStore(os.getenv("LINE_COUNTS_PATH", LINE_COUNTS_PATH)),
+        "workers": int(os.getenv("LINE_COUNT_WORKERS", LINE_COUNT_WORKERS)),
+        "object_store": os.getenv("COUNT_FROM_OBJECT_STORE", "false").lower() == "true",
+        "blob_cache": BlobLineCache(os.getenv("BLOB_CACHE_PATH", BLOB_CACHE_PATH)),
+        "language_counts": JSONStore(
+            os.getenv("LANGUAGE_COUNTS_PATH", LANGUAGE_COUNTS_PATH)
+        ),
+        "git_concurrency": int(os.getenv("GIT_CONCURRENCY", GIT_CONCURRENCY)),
+        "pool_size": int(pool_size) if pool_size else None,
+        "timeout": (
+            float(os.getenv("HTTP_CONNECT_TIMEOUT", CONNECT_TIMEOUT)),
+            float(os.getenv("HTTP_READ_TIMEOUT", READ_TIMEOUT)),
+        ),
+        "run_reports": JSONStore(run_reports_path) if run_reports_path else None,
+        "metrics_path": os.getenv("METRICS_PATH"),
+    }
+
+
+def intervals_from_env():
+    return {
+        stage: float(os.getenv(f"{stage.upper()}_INTERVAL", interval))
+        for stage, interval in STAGE_INTERVALS.items()
+    }
+
+
+def main():
     dotenv.load_dotenv()
     USERNAME = os.getenv("USERNAME")
+    USERNAMES = os.getenv("USERNAMES")
     TOKEN = os.getenv("GITHUB_PAT")
+    DAEMON = os.getenv("CRAWLER_DAEMON", "false").lower() == "true"
+    options = options_from_env()
+
+    pool = None
+    if options["workers"] > 1:
+        # Every crawl of the process counts lines in one pool, forked before any thread
+        pool = ProcessPoolExecutor(max_workers=options["workers"])
+        pool.submit(int).result()
+
+    if USERNAMES:
+        usernames = [username.strip() for username in USERNAMES.split(",")]
+        user_workers = int(os.getenv("USER_WORKERS", USER_WORKERS))
+        requester = Requester(
+            pool_size=options.pop("pool_size")
+            or shared_pool_size(user_workers, options),
+            timeout=options.pop("timeout"),
+            logger=get_logger(),
+        )
 
-    db_session = next(get_db())
-    Crawler = Crawler(username=USERNAME, token=TOKEN, db=db_session)
-    Crawler.run()
+        def crawl(stages=STAGES):
+            crawl_users(
+                usernames,
+                TOKEN,
+                session_local,
+                user_workers=user_workers,
+                stages=stages,
+                requester=requester,
+                pool=pool,
+                **options,
+            )
+
+    else:
+        db_session = next(get_db())
+        crawler = Crawler(
+            username=USERNAME, token=TOKEN, db=db_session, pool=pool, **options
+        )
+        crawl = crawler.run
+
+    try:
+        if DAEMON:
+            daemon = Daemon(
+                crawl,
+                intervals=intervals_from_env(),
+                jitter=float(os.getenv("CRAWLER_JITTER", JITTER)),
+            )
+            signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+            signal.signal(signal.SIGINT, lambda signum, frame: daemon.stop())
+            daemon.run_forever()
+        else:
+            with crawl_lock() as locked:
+                if locked:
+                    crawl()
+                else:
+                    get_logger().info("Another crawl is in progress, skipping")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
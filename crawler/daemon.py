@@ -0,0 +1,100 @@
+import fcntl
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds between refreshes of each crawler stage
+STAGE_INTERVALS = {
+    "last_year_contributions": 10 * 60,
+    "total_contributions": 60 * 60,
+    "language_usage": 60 * 60,
+    "total_lines": 24 * 60 * 60,
+}
+# Each interval is stretched or shrunk by up to this fraction
+JITTER = 0.1
+LOCK_PATH = "./cache/crawler.lock"
+
+
+@contextmanager
+def crawl_lock(path: str = LOCK_PATH):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with open(path, "w") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Daemon:
+    def __init__(
+        self,
+        crawl,
+        intervals: dict[str, float] = STAGE_INTERVALS,
+        jitter: float = JITTER,
+        lock_path: str = LOCK_PATH,
+        clock=time.monotonic,
+        logger=None,
+    ):
+        self.crawl = crawl
+        self.intervals = intervals
+        self.jitter = jitter
+        self.lock_path = lock_path
+        self.clock = clock
+        self.logger = logger or logging.getLogger("CrawlerLogger")
+        self.stopped = threading.Event()
+
+        now = clock()
+        self.next_run = {stage: now for stage in intervals}
+
+    def due_stages(self):
+        now = self.clock()
+        return [stage for stage, due in self.next_run.items() if due <= now]
+
+    def _schedule(self, stage):
+        interval = self.intervals[stage]
+        interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        # Counted from the end of the crawl so a slow stage never overlaps itself
+        self.next_run[stage] = self.clock() + interval
+
+    def run_once(self):
+        stages = self.due_stages()
+        if not stages:
+            return []
+
+        with crawl_lock(self.lock_path) as locked:
+            if not locked:
+                self.logger.info("Another crawl is in progress, skipping")
+                for stage in stages:
+                    self._schedule(stage)
+                return []
+
+            self.logger.info(f"Refreshing {', '.join(stages)}")
+            try:
+                self.crawl(stages)
+            except Exception as e:
+                self.logger.error(f"Refreshing {', '.join(stages)} failed: {str(e)}")
+
+        for stage in stages:
+            self._schedule(stage)
+        return stages
+
+    def run_forever(self):
+        while not self.stopped.is_set():
+            self.run_once()
+            wait = min(self.next_run.values()) - self.clock()
+            self.stopped.wait(max(wait, 0))
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,47 @@
+import requests
+from crawler.store import JSONStore
+
+
+class HTTPCache(JSONStore):
+    def conditional_headers(self, url):
+        entry = self.get(url)
+        if entry is None:
+            return {}
+
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def resolve(self, url, response):
+        if response.status_code == 304:
+            entry = self.get(url)
+            if entry is None:
+                return response
+
+            cached = requests.Response()
+            cached.status_code = 200
+            cached.url = url
+            cached.encoding = "utf-8"
+            cached._content = entry["body"].encode("utf-8")
+            # Paginated listings need the next page link of the cached response
+            if entry.get("link"):
+                cached.headers["Link"] = entry["link"]
+            return cached
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.ok and (etag or last_modified):
+            self.set(
+                url,
+                {
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "link": response.headers.get("Link"),
+                    "body": response.text,
+                },
+            )
+
+        return response
@@ -0,0 +1,74 @@
+import os
+
+READ_BUFFER_SIZE = 1024 * 1024
+# Same heuristic git uses to tell binary files apart, so that full counts agree
+# with the line stats of `git diff --numstat`
+BINARY_SNIFF_SIZE = 8000
+
+
+def is_binary(data):
+    return b"\0" in data[:BINARY_SNIFF_SIZE]
+
+
+def count_stream_lines(stream, size):
+    if size == 0:
+        return 0
+
+    buffer = bytearray(min(size, READ_BUFFER_SIZE))
+    view = memoryview(buffer)
+    lines = 0
+    last_byte = None
+    binary = False
+    remaining = size
+    while remaining:
+        read = stream.readinto(view[: min(remaining, len(buffer))])
+        if not read:
+            break
+
+        # Binary data is still drained so that piped streams stay in sync
+        if last_byte is None and is_binary(buffer[:read]):
+            binary = True
+
+        remaining -= read
+        last_byte = buffer[read - 1]
+        if not binary:
+            lines += buffer.count(b"\n", 0, read)
+
+    if binary:
+        return 0
+
+    if last_byte is not None and last_byte != ord("\n"):
+        lines += 1
+
+    return lines
+
+
+def count_file_lines(file_path):
+    with open(file_path, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        return count_stream_lines(f, size)
+
+
+def count_files(file_paths):
+    counts = []
+    failed = []
+    for file_path in file_paths:
+        try:
+            counts.append(count_file_lines(file_path))
+        except Exception as e:
+            counts.append(0)
+            failed.append((file_path, str(e)))
+
+    return counts, failed
+
+
+def file_size(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+def batched(items, size):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
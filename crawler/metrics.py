@@ -0,0 +1,115 @@
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+STAGE_COUNTERS = [
+    "wall_seconds",
+    "http_requests",
+    "http_bytes",
+    "git_seconds",
+    "files_scanned",
+    "bytes_scanned",
+    "db_seconds",
+]
+METRIC_PREFIX = "crawler"
+
+
+class RunMetrics:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.started = clock()
+        self.current_stage = None
+        self.stages = {}
+        self.repos = {}
+
+    @contextmanager
+    def stage(self, name):
+        # Worker threads started by the stage are counted towards it as well
+        self.current_stage = name
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add("wall_seconds", self.clock() - start)
+            self.current_stage = None
+
+    def add(self, counter, value):
+        with self.lock:
+            stage = self.stages.setdefault(
+                self.current_stage or "other", dict.fromkeys(STAGE_COUNTERS, 0)
+            )
+            stage[counter] += value
+
+    @contextmanager
+    def timer(self, counter):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add(counter, self.clock() - start)
+
+    def add_repo(self, repo, counter, value):
+        with self.lock:
+            counters = self.repos.setdefault(repo, {})
+            counters[counter] = counters.get(counter, 0) + value
+
+    def report(self, **fields):
+        with self.lock:
+            return {
+                **fields,
+                "wall_seconds": self.clock() - self.started,
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "repos": {name: dict(repo) for name, repo in self.repos.items()},
+            }
+
+
+def to_prometheus(reports):
+    lines = [
+        f"# TYPE {METRIC_PREFIX}_run_wall_seconds gauge",
+        f"# TYPE {METRIC_PREFIX}_run_completed gauge",
+    ]
+    for report in reports:
+        labels = f'user="{report["username"]}"'
+        lines.append(
+            f"{METRIC_PREFIX}_run_wall_seconds{{{labels}}} {report['wall_seconds']}"
+        )
+        completed = int(report["status"] == "completed")
+        lines.append(f"{METRIC_PREFIX}_run_completed{{{labels}}} {completed}")
+
+    for counter in STAGE_COUNTERS:
+        lines.append(f"# TYPE {METRIC_PREFIX}_stage_{counter} gauge")
+        for report in reports:
+            for stage, counters in report["stages"].items():
+                labels = f'user="{report["username"]}",stage="{stage}"'
+                lines.append(
+                    f"{METRIC_PREFIX}_stage_{counter}{{{labels}}} {counters[counter]}"
+                )
+
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path, reports):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    # The node exporter textfile collector must never see a partial file, and
+    # crawls writing at the same time must not share a temporary file
+    with tempfile.NamedTemporaryFile(
+        "w",
+        encoding="utf-8",
+        dir=directory or ".",
+        prefix=f"{os.path.basename(path)}.",
+        suffix=".tmp",
+        delete=False,
+    ) as f:
+        f.write(to_prometheus(reports))
+    try:
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, path)
+    except OSError:
+        os.remove(f.name)
+        raise
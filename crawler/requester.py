@@ -0,0 +1,180 @@
+import random
+import threading
+import time
+import requests
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+# GitHub's secondary rate limit allows about 900 REST points per minute
+MAX_REQUEST_RATE = 15.0
+BURST = 15
+# Below this many remaining requests, the rest of the budget is spread evenly
+# until the rate limit window resets
+BUDGET_RESERVE = 100
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+POOL_SIZE = 10
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 30.0
+
+
+class TokenBucket:
+    def __init__(
+        self,
+        rate: float = MAX_REQUEST_RATE,
+        capacity: int = BURST,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.rate = rate
+        self.max_rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            self.sleep(wait)
+
+    def update(self, remaining, seconds_to_reset):
+        with self.lock:
+            self._refill()
+            if remaining <= BUDGET_RESERVE:
+                self.rate = max(remaining, 1) / max(seconds_to_reset, 1)
+            else:
+                self.rate = self.max_rate
+            self.tokens = min(self.tokens, remaining)
+
+
+class Requester:
+    def __init__(
+        self,
+        max_retries: int = MAX_RETRIES,
+        pool_size: int = POOL_SIZE,
+        timeout: tuple[float, float] = (CONNECT_TIMEOUT, READ_TIMEOUT),
+        clock=time.time,
+        sleep=time.sleep,
+        logger=None,
+    ):
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.logger = logger
+        self.buckets = {
+            "core": TokenBucket(sleep=sleep),
+            "graphql": TokenBucket(sleep=sleep),
+        }
+
+        # One keep-alive session shared by all threads, so REST and GraphQL
+        # calls reuse pooled connections instead of a new TLS handshake each
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+
+    def _send(self, method, url, **kwargs):
+        return self.http.request(method, url, timeout=self.timeout, **kwargs)
+
+    def close(self):
+        self.http.close()
+
+    def _resource(self, url):
+        return "graphql" if url.endswith("/graphql") else "core"
+
+    def _update_budget(self, resource, response):
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset = response.headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+
+        resource = response.headers.get("X-RateLimit-Resource", resource)
+        bucket = self.buckets.get(resource, self.buckets["core"])
+        bucket.update(int(remaining), int(reset) - self.clock())
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+
+    def _parse_retry_after(self, retry_after):
+        # Retry-After is either a number of seconds or an HTTP date
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            pass
+
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        return max(retry_at.timestamp() - self.clock(), 0)
+
+    def _retry_delay(self, response, attempt):
+        retry_after = response.headers.get("Retry-After")
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        rate_limited = response.status_code in (403, 429) and (
+            retry_after is not None or remaining == "0"
+        )
+
+        if response.status_code not in RETRY_STATUS_CODES and not rate_limited:
+            return None
+
+        if retry_after is not None:
+            delay = self._parse_retry_after(retry_after)
+            if delay is not None:
+                return delay
+
+        reset = response.headers.get("X-RateLimit-Reset")
+        if remaining == "0" and reset is not None:
+            return max(int(reset) - self.clock(), 0) + self._backoff(0)
+
+        return self._backoff(attempt)
+
+    def _log_retry(self, message):
+        if self.logger is not None:
+            self.logger.warning(message)
+
+    def request(self, method, url, **kwargs):
+        resource = self._resource(url)
+        for attempt in range(self.max_retries + 1):
+            self.buckets[resource].acquire()
+            try:
+                response = self._send(method, url, **kwargs)
+
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                self._log_retry(
+                    f"{method} {url} failed ({e}), retrying in {delay:.1f}s"
+                )
+                self.sleep(delay)
+                continue
+
+            self._update_budget(resource, response)
+            delay = self._retry_delay(response, attempt)
+            if delay is None or attempt == self.max_retries:
+                return response
+
+            self._log_retry(
+                f"{method} {url} returned {response.status_code}, "
+                f"retrying in {delay:.1f}s"
+            )
+            self.sleep(delay)
@@ -1,4 +1,5 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, make_url, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, Session
 import dotenv
 import os
@@ -10,7 +11,57 @@ engine = create_engine(os.getenv("DATABASE_URL"))
 session_local = sessionmaker(
     class_=Session, autocommit=False, autoflush=False, bind=engine
 )
-Base.metadata.create_all(bind=engine)
+
+# Columns added to tables that older deployments already have, create_all only
+# creates missing tables and never alters existing ones
+UPGRADE_COLUMNS = {
+    "crawl_runs": {"username": "VARCHAR"},
+    "last_year_contributions": {"run_id": "INTEGER REFERENCES crawl_runs(id)"},
+    "total_contributions": {"run_id": "INTEGER REFERENCES crawl_runs(id)"},
+    "language_usage": {"run_id": "INTEGER REFERENCES crawl_runs(id)"},
+    "total_lines": {"run_id": "INTEGER REFERENCES crawl_runs(id)"},
+}
+
+
+def upgrade_schema(engine):
+    Base.metadata.create_all(bind=engine)
+
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table, columns in UPGRADE_COLUMNS.items():
+            existing = {column["name"] for column in inspector.get_columns(table)}
+            for name, definition in columns.items():
+                if name not in existing:
+                    connection.execute(
+                        text(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+                    )
+
+        # Indexes on the added columns are only created together with a table
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+
+
+upgrade_schema(engine)
+
+# Drivers used by the API's async engine for each database backend
+ASYNC_DRIVERS = {"postgresql": "asyncpg", "sqlite": "aiosqlite"}
+
+
+def async_database_url(url: str) -> str:
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend in ASYNC_DRIVERS:
+        url = url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+    return url.render_as_string(hide_password=False)
+
+
+async_engine = create_async_engine(
+    os.getenv("ASYNC_DATABASE_URL") or async_database_url(os.getenv("DATABASE_URL"))
+)
+async_session_local = async_sessionmaker(
+    class_=AsyncSession, autoflush=False, expire_on_commit=False, bind=async_engine
+)
 
 
 # Dependency to get the database session
@@ -20,3 +71,9 @@ def get_db():
         yield database
     finally:
         database.close()
+
+
+# Dependency to get an async database session for the API
+async def get_async_db():
+    async with async_session_local() as database:
+        yield database
@@ -1,5 +1,13 @@
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy import Column, Integer, DateTime, String
+from sqlalchemy import (
+    Column,
+    Integer,
+    DateTime,
+    String,
+    ForeignKey,
+    Index,
+    LargeBinary,
+)
 from datetime import datetime
 
 
@@ -7,10 +15,24 @@ class Base(DeclarativeBase):
     pass
 
 
+class DBCrawlRun(Base):
+    __tablename__ = "crawl_runs"
+    __table_args__ = (
+        Index("ix_crawl_runs_username_status_id", "username", "status", "id"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    username = Column(String)
+    status = Column(String, default="running")
+    started_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime)
+
+
 class DBLastYearContributions(Base):
     __tablename__ = "last_year_contributions"
 
     id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey("crawl_runs.id"), index=True)
     date = Column(DateTime)
     count = Column(Integer)
     level = Column(Integer)
@@ -21,6 +43,7 @@ class DBTotalContributions(Base):
     __tablename__ = "total_contributions"
 
     id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey("crawl_runs.id"), index=True)
     total_contributions = Column(Integer)
     date_created = Column(DateTime, default=datetime.now)
 
@@ -29,6 +52,7 @@ class DBLanguageUsage(Base):
     __tablename__ = "language_usage"
 
     id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey("crawl_runs.id"), index=True)
     language = Column(String)
     count = Column(Integer)
     date_created = Column(DateTime, default=datetime.now)
@@ -38,5 +62,16 @@ class DBTotalLines(Base):
     __tablename__ = "total_lines"
 
     id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey("crawl_runs.id"), index=True)
     total_lines = Column(Integer)
     date_created = Column(DateTime, default=datetime.now)
+
+
+class DBPayload(Base):
+    __tablename__ = "payloads"
+
+    run_id = Column(Integer, ForeignKey("crawl_runs.id"), primary_key=True)
+    name = Column(String, primary_key=True)
+    content = Column(LargeBinary)
+    gzip_content = Column(LargeBinary)
+    date_created = Column(DateTime, default=datetime.now)
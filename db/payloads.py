@@ -0,0 +1,45 @@
+import gzip
+from pydantic import TypeAdapter
+from db.schemas import (
+    LastYearContributions,
+    TotalContributions,
+    LanguageUsage,
+    TotalLines,
+)
+from db.models import (
+    DBLastYearContributions,
+    DBTotalContributions,
+    DBLanguageUsage,
+    DBTotalLines,
+)
+
+PAYLOAD_ADAPTERS = {
+    "last_year_contributions": TypeAdapter(list[LastYearContributions]),
+    "total_contributions": TypeAdapter(TotalContributions),
+    "language_usage": TypeAdapter(list[LanguageUsage]),
+    "total_lines": TypeAdapter(TotalLines),
+}
+PAYLOAD_NAMES = {
+    DBLastYearContributions: "last_year_contributions",
+    DBTotalContributions: "total_contributions",
+    DBLanguageUsage: "language_usage",
+    DBTotalLines: "total_lines",
+}
+# Endpoints that return one object instead of a list
+SINGLE_ROW_PAYLOADS = {"total_contributions", "total_lines"}
+GZIP_LEVEL = 9
+
+
+def encode_payload(name, value) -> tuple[bytes, bytes]:
+    adapter = PAYLOAD_ADAPTERS[name]
+    content = adapter.dump_json(adapter.validate_python(value, from_attributes=True))
+    return content, compress(content)
+
+
+def compress(content: bytes) -> bytes:
+    # A fixed mtime keeps the compressed bytes identical for identical content
+    return gzip.compress(content, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def encode_rows(name, rows) -> tuple[bytes, bytes]:
+    return encode_payload(name, rows[0] if name in SINGLE_ROW_PAYLOADS else rows)
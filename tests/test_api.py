@@ -1,11 +1,28 @@
+import gzip
+import hashlib
+import hmac
+import json
 import os
 import pytest
+import tempfile
+from unittest.mock import patch
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine, StaticPool
+from sqlalchemy import create_engine, NullPool
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
 from sqlalchemy.orm import sessionmaker, Session
+from api.cache import response_cache
+from api.limiter import limiter
 from api.main import app
-from db.core import Base, get_db
+from api.refresher import RepoRefresher
+from crawler.crawler import Crawler
+from db.core import Base, async_database_url, get_async_db
 from db.models import (
+    DBCrawlRun,
+    DBPayload,
     DBLastYearContributions,
     DBTotalContributions,
     DBLanguageUsage,
@@ -15,26 +32,26 @@ from datetime import datetime
 
 client = TestClient(app)
 
-DATABASE_URL = "sqlite:///:memory:"
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={
-        "check_same_thread": False,
-    },
-    poolclass=StaticPool,
+# The sync engine seeds the database that the API reads through the async engine
+DATABASE_PATH = os.path.join(tempfile.mkdtemp(), "test.db")
+engine = create_engine(f"sqlite:///{DATABASE_PATH}")
+async_engine = create_async_engine(
+    f"sqlite+aiosqlite:///{DATABASE_PATH}", poolclass=NullPool
 )
 TestingSessionLocal = sessionmaker(
     class_=Session, autocommit=False, autoflush=False, bind=engine
 )
+TestingAsyncSessionLocal = async_sessionmaker(
+    class_=AsyncSession, autoflush=False, expire_on_commit=False, bind=async_engine
+)
 
 
-def override_get_db():
-    database = TestingSessionLocal()
-    yield database
-    database.close()
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as database:
+        yield database
 
 
-app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
 
 
 @pytest.fixture(scope="session", autouse=True)
@@ -44,18 +61,49 @@ def run_before_and_after_tests():
     Base.metadata.drop_all(bind=engine)
 
 
+@pytest.fixture(autouse=True)
+def clear_response_cache():
+    response_cache.clear()
+    yield
+    response_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def reset_rate_limits():
+    limiter.reset()
+
+
+@pytest.fixture(autouse=True)
+def clear_usernames(monkeypatch):
+    # Fixture runs have no username, so no default user may be configured
+    monkeypatch.delenv("USERNAME", raising=False)
+    monkeypatch.delenv("USERNAMES", raising=False)
+
+
 @pytest.fixture(scope="module")
 def api_key():
     return os.getenv("API_KEY")
 
 
+def add_completed_run(db):
+    crawl_run = DBCrawlRun(status="completed", finished_at=datetime.now())
+    db.add(crawl_run)
+    db.flush()
+    return crawl_run.id
+
+
 @pytest.fixture()
 def mock_last_year_contributions():
     db = TestingSessionLocal()
+    run_id = add_completed_run(db)
     db.add_all(
         [
-            DBLastYearContributions(date=datetime(2024, 1, 21), count=1, level=1),
-            DBLastYearContributions(date=datetime(2024, 1, 22), count=0, level=0),
+            DBLastYearContributions(
+                run_id=run_id, date=datetime(2024, 1, 21), count=1, level=1
+            ),
+            DBLastYearContributions(
+                run_id=run_id, date=datetime(2024, 1, 22), count=0, level=0
+            ),
         ]
     )
     db.commit()
@@ -65,8 +113,9 @@ def mock_last_year_contributions():
 @pytest.fixture()
 def mock_total_contributions():
     db = TestingSessionLocal()
+    run_id = add_completed_run(db)
     db.add(
-        DBTotalContributions(total_contributions=123),
+        DBTotalContributions(run_id=run_id, total_contributions=123),
     )
     db.commit()
     db.close()
@@ -75,10 +124,11 @@ def mock_total_contributions():
 @pytest.fixture()
 def mock_language_usage():
     db = TestingSessionLocal()
+    run_id = add_completed_run(db)
     db.add_all(
         [
-            DBLanguageUsage(language="Python", count=123),
-            DBLanguageUsage(language="Java", count=123),
+            DBLanguageUsage(run_id=run_id, language="Python", count=123),
+            DBLanguageUsage(run_id=run_id, language="Java", count=123),
         ]
     )
     db.commit()
@@ -88,8 +138,9 @@ def mock_language_usage():
 @pytest.fixture()
 def mock_total_lines():
     db = TestingSessionLocal()
+    run_id = add_completed_run(db)
     db.add(
-        DBTotalLines(total_lines=123),
+        DBTotalLines(run_id=run_id, total_lines=123),
     )
     db.commit()
     db.close()
@@ -173,3 +224,319 @@ def test_get_total_lines_shouldreturn200whendbhasdata(mock_total_lines, api_key)
     assert response.status_code == 200
     data = response.json()
     assert data["total_lines"] == 123
+
+
+def test_get_total_lines_shouldreturnlatestcompletedrun_whenarunisinprogress(
+    mock_total_lines, api_key
+):
+    db = TestingSessionLocal()
+    crawl_run = DBCrawlRun(status="running")
+    db.add(crawl_run)
+    db.flush()
+    db.add(DBTotalLines(run_id=crawl_run.id, total_lines=456))
+    db.commit()
+    db.close()
+
+    response = client.get("/total_lines", headers={"api-key": api_key})
+    assert response.status_code == 200
+    assert response.json()["total_lines"] == 123
+
+
+def test_get_total_lines_shouldreturnuserrun_whenuserisgiven(mock_total_lines, api_key):
+    db = TestingSessionLocal()
+    crawl_run = DBCrawlRun(username="other_user", status="completed")
+    db.add(crawl_run)
+    db.flush()
+    db.add(DBTotalLines(run_id=crawl_run.id, total_lines=456))
+    db.commit()
+    db.close()
+
+    response = client.get(
+        "/total_lines", params={"user": "other_user"}, headers={"api-key": api_key}
+    )
+    assert response.status_code == 200
+    assert response.json()["total_lines"] == 456
+
+    response = client.get(
+        "/total_lines", params={"user": "missing_user"}, headers={"api-key": api_key}
+    )
+    assert response.status_code == 204
+
+
+def test_get_total_lines_shouldreturnfirstuserrun_whennouserisgiven(
+    api_key, monkeypatch
+):
+    monkeypatch.setenv("USERNAMES", "first_user,other_user")
+    db = TestingSessionLocal()
+    for username, total_lines in [("first_user", 111), ("other_user", 456)]:
+        crawl_run = DBCrawlRun(username=username, status="completed")
+        db.add(crawl_run)
+        db.flush()
+        db.add(DBTotalLines(run_id=crawl_run.id, total_lines=total_lines))
+    db.commit()
+    db.close()
+
+    response = client.get("/total_lines", headers={"api-key": api_key})
+    assert response.json()["total_lines"] == 111
+
+
+def sign(body, secret="webhook_secret"):
+    digest = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+def push_payload(owner="test_user", ref="refs/heads/main", private=False):
+    return json.dumps(
+        {
+            "ref": ref,
+            "repository": {
+                "name": "repo1",
+                "full_name": f"{owner}/repo1",
+                "owner": {"login": owner},
+                "private": private,
+                "default_branch": "main",
+                "pushed_at": 1704067200,
+            },
+        }
+    ).encode()
+
+
+@patch("api.auth.WEBHOOK_SECRET", "webhook_secret")
+def test_github_webhook_shouldqueuerefresh_whensignatureisvalid(monkeypatch):
+    monkeypatch.setenv("USERNAME", "test_user")
+    body = push_payload()
+
+    with patch("api.routers.refresher.enqueue") as mock_enqueue:
+        response = client.post(
+            "/webhook/github",
+            content=body,
+            headers={"X-GitHub-Event": "push", "X-Hub-Signature-256": sign(body)},
+        )
+
+        assert response.status_code == 202
+        mock_enqueue.assert_called_once_with("test_user", "repo1", 1704067200)
+
+
+@patch("api.auth.WEBHOOK_SECRET", "webhook_secret")
+def test_github_webhook_shouldreturn403_whensignatureisinvalid():
+    body = push_payload()
+
+    with patch("api.routers.refresher.enqueue") as mock_enqueue:
+        response = client.post(
+            "/webhook/github",
+            content=body,
+            headers={
+                "X-GitHub-Event": "push",
+                "X-Hub-Signature-256": sign(body, "wrong_secret"),
+            },
+        )
+
+        assert response.status_code == 403
+        mock_enqueue.assert_not_called()
+
+
+@patch("api.auth.WEBHOOK_SECRET", "webhook_secret")
+def test_github_webhook_shouldignorepush_whenownerisnotcrawled(monkeypatch):
+    monkeypatch.setenv("USERNAME", "test_user")
+    body = push_payload("other_user")
+
+    with patch("api.routers.refresher.enqueue") as mock_enqueue:
+        response = client.post(
+            "/webhook/github",
+            content=body,
+            headers={"X-GitHub-Event": "push", "X-Hub-Signature-256": sign(body)},
+        )
+
+        assert response.status_code == 202
+        mock_enqueue.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "body",
+    [push_payload(private=True), push_payload(ref="refs/heads/feature")],
+)
+@patch("api.auth.WEBHOOK_SECRET", "webhook_secret")
+def test_github_webhook_shouldignorepush_whenrepoisprivateorbranchisnotdefault(
+    body, monkeypatch
+):
+    monkeypatch.setenv("USERNAME", "test_user")
+
+    with patch("api.routers.refresher.enqueue") as mock_enqueue:
+        response = client.post(
+            "/webhook/github",
+            content=body,
+            headers={"X-GitHub-Event": "push", "X-Hub-Signature-256": sign(body)},
+        )
+
+        assert response.status_code == 202
+        mock_enqueue.assert_not_called()
+
+
+def test_refresh_shouldcountinprocessandclosesession_whenrefreshing():
+    refresher = RepoRefresher(
+        "test_token",
+        session_factory=TestingSessionLocal,
+        options_factory=lambda: {"workers": 4},
+    )
+    refreshed = []
+
+    def refresh_repos(self, pushed):
+        refreshed.append((self.workers, pushed))
+
+    with patch.object(Crawler, "refresh_repos", refresh_repos), patch(
+        "crawler.requester.Requester.close"
+    ) as mock_close:
+        refresher.refresh("test_user", {"repo1": "2024-01-01T00:00:00Z"})
+
+        mock_close.assert_called_once()
+
+    assert refreshed == [(1, {"repo1": "2024-01-01T00:00:00Z"})]
+
+
+def test_get_total_lines_shouldnotquerydb_whenresponseiscached(
+    mock_total_lines, api_key
+):
+    client.get("/total_lines", headers={"api-key": api_key})
+
+    with patch("api.routers.get_db_total_lines") as mock_service, patch(
+        "api.cache.get_latest_run_id"
+    ) as mock_run_id:
+        response = client.get("/total_lines", headers={"api-key": api_key})
+
+        mock_service.assert_not_called()
+        mock_run_id.assert_not_called()
+
+    assert response.json()["total_lines"] == 123
+
+
+def test_get_total_lines_shouldreturnnewrun_whengenerationchanged(
+    mock_total_lines, api_key
+):
+    client.get("/total_lines", headers={"api-key": api_key})
+
+    db = TestingSessionLocal()
+    run_id = add_completed_run(db)
+    db.add(DBTotalLines(run_id=run_id, total_lines=456))
+    db.commit()
+    db.close()
+    response_cache.expire()
+
+    response = client.get("/total_lines", headers={"api-key": api_key})
+    assert response.json()["total_lines"] == 456
+
+
+def test_get_total_lines_shouldservepayload_whencrawlerwroteone(api_key):
+    db = TestingSessionLocal()
+    run_id = add_completed_run(db)
+    content = b'{"id":1,"total_lines":789,"date_created":"2024-01-01T00:00:00"}'
+    db.add(
+        DBPayload(
+            run_id=run_id,
+            name="total_lines",
+            content=content,
+            gzip_content=gzip.compress(content),
+        )
+    )
+    db.commit()
+    db.close()
+
+    with patch("api.routers.get_db_total_lines") as mock_service:
+        response = client.get(
+            "/total_lines", headers={"api-key": api_key, "Accept-Encoding": "gzip"}
+        )
+
+        mock_service.assert_not_called()
+
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.content == content
+
+    response = client.get(
+        "/total_lines", headers={"api-key": api_key, "Accept-Encoding": "identity"}
+    )
+    assert "content-encoding" not in response.headers
+    assert response.content == content
+
+
+def test_get_total_lines_shouldreturn304_whenetagmatches(mock_total_lines, api_key):
+    response = client.get(
+        "/total_lines", headers={"api-key": api_key, "Accept-Encoding": "identity"}
+    )
+    etag = response.headers["etag"]
+    assert "max-age=" in response.headers["cache-control"]
+
+    response = client.get(
+        "/total_lines",
+        headers={
+            "api-key": api_key,
+            "Accept-Encoding": "identity",
+            "If-None-Match": etag,
+        },
+    )
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert response.content == b""
+
+
+def test_get_total_lines_shouldreturn304_whennotmodifiedsince(
+    mock_total_lines, api_key
+):
+    response = client.get("/total_lines", headers={"api-key": api_key})
+    last_modified = response.headers["last-modified"]
+
+    response = client.get(
+        "/total_lines",
+        headers={"api-key": api_key, "If-Modified-Since": last_modified},
+    )
+    assert response.status_code == 304
+
+    response = client.get(
+        "/total_lines",
+        headers={
+            "api-key": api_key,
+            "If-Modified-Since": "Mon, 01 Jan 2001 00:00:00 GMT",
+        },
+    )
+    assert response.status_code == 200
+
+
+def test_get_summary_shouldreturnallsections_whendbhasdata(
+    mock_total_contributions, api_key
+):
+    db = TestingSessionLocal()
+    run_id = db.query(DBCrawlRun.id).order_by(DBCrawlRun.id.desc()).limit(1).scalar()
+    db.add(DBTotalLines(run_id=run_id, total_lines=123))
+    db.commit()
+    db.close()
+
+    response = client.get("/summary", headers={"api-key": api_key})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["total_contributions"]["total_contributions"] == 123
+    assert data["total_lines"]["total_lines"] == 123
+    assert data["language_usage"] is None
+    assert data["last_year_contributions"] is None
+
+
+def test_get_summary_shouldreturnselectedsections_whensectionsaregiven(
+    mock_total_lines, api_key
+):
+    response = client.get(
+        "/summary", params={"sections": "total_lines"}, headers={"api-key": api_key}
+    )
+    assert response.status_code == 200
+    assert list(response.json()) == ["total_lines"]
+
+    response = client.get(
+        "/summary",
+        params={"sections": "total_lines,bogus"},
+        headers={"api-key": api_key},
+    )
+    assert response.status_code == 400
+
+
+def test_async_database_url_shouldswapdriver_whenbackendknown():
+    assert (
+        async_database_url("postgresql://user:secret@db:5432/stats")
+        == "postgresql+asyncpg://user:secret@db:5432/stats"
+    )
+    assert async_database_url("sqlite:///data.db") == "sqlite+aiosqlite:///data.db"
@@ -1,13 +1,29 @@
 import pytest
-from unittest.mock import patch, mock_open
-from sqlalchemy import create_engine, StaticPool
+from unittest.mock import patch
+from sqlalchemy import create_engine, inspect, text, StaticPool
 from sqlalchemy.orm import sessionmaker, Session
-from db.core import Base
+from db.core import Base, upgrade_schema
 from datetime import datetime
-from crawler.crawler import Crawler
+from crawler.crawler import Crawler, crawl_users, main
+from crawler.daemon import Daemon, crawl_lock
+from benchmarks.fake_github import FakeGitHub
+from benchmarks.run import find_regressions
+from benchmarks.synthetic import make_repos
+from crawler.http_cache import HTTPCache
+from crawler.store import JSONStore
+from crawler.blobs import BlobLineCache
+from crawler.requester import Requester, TokenBucket
+import gzip
+import json
+import os
 import requests
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from threading import Thread
 
 from db.models import (
+    DBCrawlRun,
+    DBPayload,
     DBLastYearContributions,
     DBTotalContributions,
     DBLanguageUsage,
@@ -38,6 +54,10 @@ def run_before_and_after_tests():
 def db_session():
     db = TestingSessionLocal()
     yield db
+    db.rollback()
+    for table in reversed(Base.metadata.sorted_tables):
+        db.execute(table.delete())
+    db.commit()
     db.close()
 
 
@@ -47,8 +67,10 @@ def crawler(db_session):
 
 
 def test__fetch_repos_shouldberepos_when_responseok(crawler):
-    with patch("requests.get") as mock_get:
+    with patch("requests.Session.request") as mock_get:
+        mock_get.return_value.headers = {}
         mock_get.return_value.ok = True
+        mock_get.return_value.links = {}
         mock_get.return_value.json.return_value = [{"name": "repo1"}, {"name": "repo2"}]
 
         repos = crawler._fetch_repos()
@@ -59,16 +81,62 @@ def test__fetch_repos_shouldberepos_when_responseok(crawler):
 
 
 def test__fetch_repos_shouldthrowexception_whenresponseisnotok(crawler):
-    with patch("requests.get") as mock_get:
+    with patch("requests.Session.request") as mock_get:
+        mock_get.return_value.headers = {}
         mock_get.return_value.ok = False
 
         with pytest.raises(requests.exceptions.RequestException):
             crawler._fetch_repos()
 
 
+def make_response(status_code, body=b"", headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = body
+    response.headers.update(headers or {})
+    return response
+
+
+def test__fetch_repos_shouldreusecachedbody_whenresponseisnotmodified(
+    crawler, tmp_path
+):
+    crawler.http_cache = HTTPCache(str(tmp_path / "http_cache.json"))
+    with patch("requests.Session.request") as mock_get:
+        mock_get.return_value = make_response(
+            200, b'[{"name": "repo1"}]', {"ETag": '"abc"'}
+        )
+        crawler._fetch_repos()
+        crawler.http_cache.save()
+
+        crawler.http_cache = HTTPCache(str(tmp_path / "http_cache.json"))
+        mock_get.return_value = make_response(304)
+        repos = crawler._fetch_repos()
+
+        assert mock_get.call_args.kwargs["headers"]["If-None-Match"] == '"abc"'
+        assert repos == [{"name": "repo1"}]
+
+
+def test__fetch_repos_shouldfollownextpage_whenfirstpageisnotmodified(
+    crawler, tmp_path
+):
+    crawler.http_cache = HTTPCache(str(tmp_path / "http_cache.json"))
+    next_link = '<https://api.github.com/user/1/repos?page=2>; rel="next"'
+    pages = [
+        make_response(200, b'[{"name": "a"}]', {"ETag": '"1"', "Link": next_link}),
+        make_response(200, b'[{"name": "b"}]', {"ETag": '"2"'}),
+    ]
+    with patch("requests.Session.request", side_effect=pages):
+        assert crawler._fetch_repos() == [{"name": "a"}, {"name": "b"}]
+
+    with patch("requests.Session.request", side_effect=[make_response(304)] * 2):
+        assert crawler._fetch_repos() == [{"name": "a"}, {"name": "b"}]
+
+
 def test_get_repos_shouldbeok_when_fetch_reposreturnrepos(crawler):
     with patch.object(
         crawler, "_fetch_repos", return_value=[{"name": "repo1"}, {"name": "repo2"}]
+    ), patch.object(
+        crawler, "_iter_repos", side_effect=requests.exceptions.RequestException
     ):
         crawler.get_repos()
         assert len(crawler.repos) == 2
@@ -79,14 +147,76 @@ def test_get_repos_shouldbeok_when_fetch_reposreturnrepos(crawler):
 def test_get_repos_shouldtnotupdaterepos_when_fetch_reposthrowsexception(crawler):
     with patch.object(
         crawler, "_fetch_repos", side_effect=requests.exceptions.RequestException
+    ), patch.object(
+        crawler, "_iter_repos", side_effect=requests.exceptions.RequestException
     ):
         crawler.get_repos()
 
         assert len(crawler.repos) == 0
 
 
+def repositories_page(names, has_next_page, end_cursor=None):
+    return {
+        "data": {
+            "user": {
+                "repositories": {
+                    "pageInfo": {"hasNextPage": has_next_page, "endCursor": end_cursor},
+                    "nodes": [
+                        {
+                            "name": name,
+                            "pushedAt": "2024-01-01T00:00:00Z",
+                            "diskUsage": 10,
+                            "languages": {
+                                "edges": [{"size": 123, "node": {"name": "Python"}}]
+                            },
+                        }
+                        for name in names
+                    ],
+                }
+            }
+        }
+    }
+
+
+def test__iter_repos_shouldpagethroughallrepos_whenmorethanonepage(crawler):
+    pages = [
+        make_response(
+            200, json.dumps(repositories_page(["repo1"], True, "c1")).encode()
+        ),
+        make_response(200, json.dumps(repositories_page(["repo2"], False)).encode()),
+    ]
+    with patch("requests.Session.request", side_effect=pages) as mock_post:
+        repos = list(crawler._iter_repos())
+
+    assert mock_post.call_count == 2
+    assert mock_post.call_args.kwargs["json"]["variables"]["cursor"] == "c1"
+    assert [repo["name"] for repo in repos] == ["repo1", "repo2"]
+    assert repos[0]["pushed_at"] == "2024-01-01T00:00:00Z"
+    assert repos[0]["languages"] == {"Python": 123}
+
+
+def test_get_language_usage_shouldnotcallrest_whenlanguagescamewithlisting(
+    crawler, db_session
+):
+    with patch.object(
+        crawler,
+        "_iter_repos",
+        return_value=iter([{"name": "repo1", "languages": {"Go": 7}}]),
+    ):
+        crawler.get_repos()
+
+    with patch.object(crawler, "_get_repo_languages") as mock_get:
+        crawler.get_language_usage()
+        mock_get.assert_not_called()
+
+    language = db_session.query(DBLanguageUsage).one()
+    assert language.language == "Go"
+    assert language.count == 7
+
+
 def test__fetch_last_year_contributions_shouldreturncalendar_whenresponseok(crawler):
-    with patch("requests.post") as mock_post:
+    with patch("requests.Session.request") as mock_post:
+        mock_post.return_value.headers = {}
         mock_post.return_value.ok = True
         mock_post.return_value.json.return_value = {
             "data": {
@@ -157,7 +287,8 @@ def test__parse_calendar_shouldreturncalendar_whenresponse_calendarisvalid(crawl
 def test_get_last_year_contributions_shouldupdatedb_whenresponseisok(
     crawler, db_session
 ):
-    with patch("requests.post") as mock_post:
+    with patch("requests.Session.request") as mock_post:
+        mock_post.return_value.headers = {}
         mock_post.return_value.ok = True
         mock_post.return_value.json.return_value = {
             "data": {
@@ -211,51 +342,394 @@ def test_get_last_year_contributions_shouldnotupdatedb_whenresponseisnotok(
         assert len(contributions) == 0
 
 
-def test__fetch_yearly_contributions_shouldreturncontributions_whenresponseok(crawler):
-    with patch("requests.post") as mock_post:
+def test__write_snapshot_shouldkeeppreviousrows_wheninsertfails(crawler, db_session):
+    crawler._write_snapshot(DBTotalLines, [{"total_lines": 1}])
+
+    with patch.object(
+        db_session, "commit", side_effect=RuntimeError("connection lost")
+    ):
+        with pytest.raises(RuntimeError):
+            crawler._write_snapshot(DBTotalLines, [{"total_lines": 2}])
+
+    lines = db_session.query(DBTotalLines).all()
+    assert [line.total_lines for line in lines] == [1]
+
+
+def test__write_snapshot_shouldstampallrowswithonedate_whensavingsnapshot(
+    crawler, db_session
+):
+    crawler._write_snapshot(
+        DBLanguageUsage,
+        [{"language": "Python", "count": 1}, {"language": "Go", "count": 2}],
+    )
+
+    languages = db_session.query(DBLanguageUsage).all()
+    assert len(languages) == 2
+    assert languages[0].date_created == languages[1].date_created
+
+
+def test_finish_run_shouldcarryforwardpreviousdata_whenstagedidnotwrite(
+    crawler, db_session
+):
+    crawler._write_snapshot(DBTotalLines, [{"total_lines": 10}])
+    crawler._write_snapshot(DBTotalContributions, [{"total_contributions": 5}])
+    crawler.finish_run()
+
+    crawler.start_run()
+    crawler._write_snapshot(DBTotalLines, [{"total_lines": 20}])
+    run_id = crawler.run_id
+    crawler.finish_run()
+
+    assert db_session.get(DBCrawlRun, run_id).status == "completed"
+    lines = db_session.query(DBTotalLines).filter_by(run_id=run_id).one()
+    contributions = (
+        db_session.query(DBTotalContributions).filter_by(run_id=run_id).one()
+    )
+    assert lines.total_lines == 20
+    assert contributions.total_contributions == 5
+
+
+def test_finish_run_shouldpruneoldruns_whenmorethanrunstokeep(crawler, db_session):
+    with patch("crawler.crawler.RUNS_TO_KEEP", 2):
+        for total_lines in range(3):
+            crawler._write_snapshot(DBTotalLines, [{"total_lines": total_lines}])
+            crawler.finish_run()
+
+    runs = db_session.query(DBCrawlRun).all()
+    lines = db_session.query(DBTotalLines).all()
+    assert len(runs) == 2
+    assert sorted(line.total_lines for line in lines) == [1, 2]
+
+
+def test_run_shouldmarkrunfailed_whenstageraises(crawler, db_session):
+    with patch.object(crawler, "get_repos", side_effect=RuntimeError):
+        with pytest.raises(RuntimeError):
+            crawler.run()
+
+    crawl_run = db_session.query(DBCrawlRun).one()
+    assert crawl_run.status == "failed"
+
+
+def test_finish_run_shouldcarryforwardonlyownuser_whenseveralusersarecrawled(
+    crawler, db_session
+):
+    other = Crawler(username="other_user", token="test_token", db=db_session)
+    other._write_snapshot(DBTotalLines, [{"total_lines": 99}])
+    other.finish_run()
+
+    crawler.start_run()
+    run_id = crawler.run_id
+    crawler.finish_run()
+
+    assert db_session.get(DBCrawlRun, run_id).username == "test_user"
+    assert db_session.query(DBTotalLines).filter_by(run_id=run_id).count() == 0
+
+
+def test_crawl_users_shouldruneachuser_whenworkersaresharingthequeue(db_session):
+    crawled = []
+
+    def run(self, stages):
+        crawled.append((self.username, self.requester))
+
+    with patch.object(Crawler, "run", run):
+        crawl_users(["user1", "user2", "user3"], "test_token", TestingSessionLocal, 2)
+
+    assert sorted(username for username, _ in crawled) == ["user1", "user2", "user3"]
+    assert len({id(requester) for _, requester in crawled}) == 1
+
+
+def test_main_shouldcrawleachuser_whenusernamesareset(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("USERNAMES", "user1, user2")
+    monkeypatch.setenv("USER_WORKERS", "2")
+    monkeypatch.setenv("LINE_COUNT_WORKERS", "1")
+    monkeypatch.setenv("CRAWLER_CONCURRENCY", "8")
+    monkeypatch.delenv("CRAWLER_DAEMON", raising=False)
+    monkeypatch.delenv("HTTP_POOL_SIZE", raising=False)
+    crawled = []
+
+    def run(self, stages):
+        crawled.append((self.username, self.workers, self.requester))
+
+    with patch.object(Crawler, "run", run), patch(
+        "crawler.crawler.session_local", TestingSessionLocal
+    ):
+        main()
+
+    assert sorted(username for username, _, _ in crawled) == ["user1", "user2"]
+    assert {workers for _, workers, _ in crawled} == {1}
+    adapter = crawled[0][2].http.get_adapter("https://api.github.com")
+    assert adapter._pool_maxsize == 16
+
+
+def test_main_shouldshareonelinecountpool_whencrawlingrepeatedly(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("USERNAMES", "user1,user2")
+    monkeypatch.setenv("LINE_COUNT_WORKERS", "2")
+    monkeypatch.delenv("CRAWLER_DAEMON", raising=False)
+    pools = []
+
+    def run(self, stages):
+        pools.append(self.pool)
+
+    with patch.object(Crawler, "run", run), patch(
+        "crawler.crawler.session_local", TestingSessionLocal
+    ):
+        main()
+
+    assert isinstance(pools[0], ProcessPoolExecutor)
+    assert pools == [pools[0], pools[0]]
+
+
+def test_run_shouldrefreshonlygivenstages_whenstagesaregiven(crawler, db_session):
+    with patch.object(crawler, "get_repos") as mock_repos, patch.object(
+        crawler, "get_last_year_contributions"
+    ) as mock_calendar, patch.object(crawler, "get_total_lines") as mock_lines:
+        crawler.run(["last_year_contributions"])
+
+        mock_calendar.assert_called_once()
+        mock_repos.assert_not_called()
+        mock_lines.assert_not_called()
+
+    assert db_session.query(DBCrawlRun).one().status == "completed"
+
+
+def test_daemon_run_once_shouldrunonlyduestages_whenintervalsdiffer(tmp_path):
+    now = [0.0]
+    crawled = []
+    daemon = Daemon(
+        crawled.append,
+        intervals={"fast": 10, "slow": 100},
+        jitter=0,
+        lock_path=str(tmp_path / "crawler.lock"),
+        clock=lambda: now[0],
+    )
+
+    assert daemon.run_once() == ["fast", "slow"]
+    now[0] = 50
+    assert daemon.run_once() == ["fast"]
+    assert daemon.run_once() == []
+    assert crawled == [["fast", "slow"], ["fast"]]
+
+
+def test_daemon_run_once_shouldskipcrawl_whenanothercrawlholdsthelock(tmp_path):
+    lock_path = str(tmp_path / "crawler.lock")
+    crawled = []
+    daemon = Daemon(crawled.append, intervals={"fast": 10}, lock_path=lock_path)
+
+    with crawl_lock(lock_path) as locked:
+        assert locked
+        assert daemon.run_once() == []
+
+    assert crawled == []
+    assert daemon.due_stages() == []
+
+
+def test_refresh_repos_shouldrecountonlypushedrepo_whenotherreposarestored(
+    crawler, db_session, tmp_path
+):
+    crawler.language_counts = JSONStore(str(tmp_path / "language_counts.json"))
+    crawler.line_counts = JSONStore(str(tmp_path / "line_counts.json"))
+    for repo, lines in [("repo1", 10), ("repo2", 20)]:
+        crawler.language_counts.set(
+            f"test_user/{repo}",
+            {"pushed_at": "2024-01-01T00:00:00Z", "languages": {"Python": lines}},
+        )
+        crawler.line_counts.set(
+            f"test_user/{repo}",
+            {"sha": "abc", "lines": lines, "pushed_at": "2024-01-01T00:00:00Z"},
+        )
+
+    with patch.object(crawler, "get_repos") as mock_repos, patch.object(
+        crawler, "_get_repo_languages", return_value={"Python": 30}
+    ) as mock_languages, patch.object(
+        crawler, "_sync_repos", return_value=[(1, "repo2", True)]
+    ) as mock_sync, patch.object(
+        crawler, "_count_repo_lines", return_value=30
+    ):
+        crawler.refresh_repos({"repo2": "2024-02-01T00:00:00Z"})
+
+        mock_repos.assert_not_called()
+        mock_languages.assert_called_once_with("repo2")
+        mock_sync.assert_called_once_with([(1, "repo2")])
+
+    lines = db_session.query(DBTotalLines).one()
+    language = db_session.query(DBLanguageUsage).one()
+    assert lines.total_lines == 40
+    assert language.count == 40
+
+
+def test_refresh_repos_shouldnotcrawl_whennocountsarestored(crawler, tmp_path):
+    crawler.language_counts = JSONStore(str(tmp_path / "language_counts.json"))
+    crawler.line_counts = JSONStore(str(tmp_path / "line_counts.json"))
+
+    with patch.object(crawler, "run") as mock_run, patch.object(
+        crawler, "_run_stages"
+    ) as mock_stages:
+        crawler.refresh_repos({"repo1": "2024-02-01T00:00:00Z"})
+
+        mock_run.assert_not_called()
+        mock_stages.assert_not_called()
+
+
+def test_run_shouldwritereport_whenrunfinishes(crawler, db_session, tmp_path):
+    crawler.run_reports = JSONStore(str(tmp_path / "run_reports.json"))
+    crawler.metrics_path = str(tmp_path / "crawler.prom")
+
+    def get_last_year_contributions():
+        crawler._post_graphql("query { viewer { login } }")
+
+    def get_total_contributions():
+        crawler._write_snapshot(DBTotalContributions, [{"total_contributions": 5}])
+
+    with patch("requests.Session.request") as mock_post, patch.object(
+        crawler, "get_last_year_contributions", get_last_year_contributions
+    ), patch.object(crawler, "get_total_contributions", get_total_contributions):
+        mock_post.return_value = make_response(200, b'{"data": {}}')
+        crawler.run(["last_year_contributions", "total_contributions"])
+
+    report = JSONStore(str(tmp_path / "run_reports.json")).get("test_user")
+    calendar = report["stages"]["last_year_contributions"]
+    assert report["status"] == "completed"
+    assert calendar["http_requests"] == 1
+    assert calendar["http_bytes"] == len(b'{"data": {}}')
+    assert report["stages"]["total_contributions"]["db_seconds"] > 0
+
+    metrics = (tmp_path / "crawler.prom").read_text()
+    assert (
+        'crawler_stage_http_requests{user="test_user",'
+        'stage="last_year_contributions"} 1'
+    ) in metrics
+    assert 'crawler_run_completed{user="test_user"} 1' in metrics
+
+
+def test__report_run_shouldwriteeveryreport_whenusersfinishtogether(
+    db_session, tmp_path
+):
+    run_reports = JSONStore(str(tmp_path / "run_reports.json"))
+    metrics_path = str(tmp_path / "crawler.prom")
+    crawlers = [
+        Crawler(
+            username=f"user{i}",
+            token="test_token",
+            db=db_session,
+            run_reports=run_reports,
+            metrics_path=metrics_path,
+        )
+        for i in range(8)
+    ]
+
+    threads = [
+        Thread(target=crawler._report_run, args=(i, "completed"))
+        for i, crawler in enumerate(crawlers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    metrics = (tmp_path / "crawler.prom").read_text()
+    for i in range(8):
+        assert f'crawler_run_completed{{user="user{i}"}} 1' in metrics
+    assert sorted(os.listdir(tmp_path)) == ["crawler.prom", "run_reports.json"]
+
+
+def test_finish_run_shouldwritepayloads_whenstagesarewrittenandcarried(
+    crawler, db_session
+):
+    crawler._write_snapshot(DBTotalContributions, [{"total_contributions": 5}])
+    crawler.finish_run()
+
+    crawler._write_snapshot(DBTotalLines, [{"total_lines": 20}])
+    run_id = crawler.run_id
+    crawler.finish_run()
+
+    lines = db_session.get(DBPayload, (run_id, "total_lines"))
+    contributions = db_session.get(DBPayload, (run_id, "total_contributions"))
+    assert json.loads(lines.content)["total_lines"] == 20
+    assert json.loads(gzip.decompress(lines.gzip_content)) == json.loads(lines.content)
+    assert json.loads(contributions.content)["total_contributions"] == 5
+
+
+def test__fetch_start_year_shouldreturnaccountcreationyear_whenresponseok(crawler):
+    with patch("requests.Session.request") as mock_post:
+        mock_post.return_value.headers = {}
+        mock_post.return_value.ok = True
+        mock_post.return_value.json.return_value = {
+            "data": {"user": {"createdAt": "2021-03-04T05:06:07Z"}}
+        }
+
+        assert crawler._fetch_start_year() == 2021
+
+
+def test__fetch_contributions_by_year_shouldsendonequery_whenmultipleyears(crawler):
+    with patch("requests.Session.request") as mock_post:
+        mock_post.return_value.headers = {}
         mock_post.return_value.ok = True
         mock_post.return_value.json.return_value = {
             "data": {
                 "user": {
-                    "contributionsCollection": {
+                    "y2023": {
+                        "restrictedContributionsCount": 10,
+                        "contributionCalendar": {"totalContributions": 20},
+                    },
+                    "y2024": {
                         "restrictedContributionsCount": 50,
-                        "contributionCalendar": {
-                            "totalContributions": 100,
-                        },
-                    }
+                        "contributionCalendar": {"totalContributions": 100},
+                    },
                 }
             }
         }
 
-        contributions = crawler._fetch_yearly_contributions(2024)
+        contributions = crawler._fetch_contributions_by_year([2023, 2024])
 
-        assert contributions["restrictedContributionsCount"] == 50
-        assert contributions["contributionCalendar"]["totalContributions"] == 100
+        assert mock_post.call_count == 1
+        query = mock_post.call_args.kwargs["json"]["query"]
+        assert 'y2023: contributionsCollection(to: "2023-12-31T00:00:00Z")' in query
+        assert 'y2024: contributionsCollection(to: "2024-12-31T00:00:00Z")' in query
+        assert contributions[2023]["restrictedContributionsCount"] == 10
+        assert contributions[2024]["contributionCalendar"]["totalContributions"] == 100
 
 
 def test_get_total_contributions_shouldupdatedb_whenresponseisok(crawler, db_session):
-    with patch.object(crawler, "_fetch_yearly_contributions") as mock_fetch:
-        mock_fetch.return_value = {
-            "restrictedContributionsCount": 50,
-            "contributionCalendar": {"totalContributions": 100},
+    crawler.start_year = 2022
+    with patch.object(crawler, "_fetch_contributions_by_year") as mock_fetch:
+        mock_fetch.side_effect = lambda years: {
+            year: {
+                "restrictedContributionsCount": 50,
+                "contributionCalendar": {"totalContributions": 100},
+            }
+            for year in years
         }
 
         crawler.get_total_contributions()
 
         contributions = db_session.query(DBTotalContributions).first()
-        first_year = 2022
-        this_year = datetime.now().year
-        number_of_years = this_year - first_year + 1
+        number_of_years = datetime.now().year - 2022 + 1
 
+        assert mock_fetch.call_count == 1
         assert contributions.total_contributions == 150 * number_of_years
 
 
+def test_get_total_contributions_shoulddiscoverstartyear_whennotconfigured(crawler):
+    with patch.object(crawler, "_fetch_start_year", return_value=2020):
+        with patch.object(
+            crawler, "_fetch_contributions_by_year", return_value={}
+        ) as mock_fetch:
+            crawler.get_total_contributions()
+
+            years = mock_fetch.call_args.args[0]
+            assert years[0] == 2020
+            assert years[-1] == datetime.now().year
+
+
 def test_get_total_contributions_shouldnotupdatedb_whenresponseisnotok(
     crawler, db_session
 ):
+    crawler.start_year = 2022
     with patch.object(
         crawler,
-        "_fetch_yearly_contributions",
+        "_fetch_contributions_by_year",
         side_effect=requests.exceptions.RequestException,
     ):
         db_session.query(DBTotalContributions).delete()
@@ -266,7 +740,8 @@ def test_get_total_contributions_shouldnotupdatedb_whenresponseisnotok(
 
 
 def test__get_repo_languages_shouldreturnlanguages_whenresponseisok(crawler):
-    with patch("requests.get") as mock_get:
+    with patch("requests.Session.request") as mock_get:
+        mock_get.return_value.headers = {}
         mock_get.return_value.ok = True
         mock_get.return_value.json.return_value = {"Python": 123, "Java": 456}
 
@@ -278,7 +753,8 @@ def test__get_repo_languages_shouldreturnlanguages_whenresponseisok(crawler):
 
 
 def test__get_repo_languages_shouldreturnNone_whenresponseisnotok(crawler):
-    with patch("requests.get") as mock_get:
+    with patch("requests.Session.request") as mock_get:
+        mock_get.return_value.headers = {}
         mock_get.return_value.ok = False
 
         languages = crawler._get_repo_languages("repo1")
@@ -334,31 +810,498 @@ def test_get_language_usage_shouldreturnNone_wehnnoreposfound(crawler, db_sessio
         assert len(languages) == 0
 
 
-def test__count_lines_shouldreturnlines_whenresponseisok(crawler):
-    mock_file_content = "line1\nline2\nline3\n"
-    crawler.total_lines = 0
+def test_get_language_usage_shouldmergeallrepos_whenfetchedconcurrently(
+    crawler, db_session
+):
+    repo_languages = {
+        "repo1": {"Python": 100},
+        "repo2": {"Python": 20, "Go": 5},
+        "repo3": None,
+    }
+    with patch.object(crawler, "_get_repo_languages", side_effect=repo_languages.get):
+        crawler.concurrency = 2
+        crawler.repos = list(repo_languages)
+        crawler.get_language_usage()
+
+        languages = db_session.query(DBLanguageUsage).all()
+        counts = {language.language: language.count for language in languages}
+        assert counts == {"Python": 120, "Go": 5}
+
+
+def test_get_language_usage_shouldskipfetch_whenrepowasnotpushedsincelastcrawl(
+    crawler, db_session, tmp_path
+):
+    crawler.language_counts = JSONStore(str(tmp_path / "language_counts.json"))
+    crawler.language_counts.set(
+        "test_user/repo1",
+        {"pushed_at": "2024-01-01T00:00:00Z", "languages": {"Python": 10}},
+    )
+    crawler.repos = ["repo1", "repo2"]
+    crawler.repo_metadata = {
+        "repo1": {"name": "repo1", "pushed_at": "2024-01-01T00:00:00Z"},
+        "repo2": {"name": "repo2", "pushed_at": "2024-02-01T00:00:00Z"},
+    }
+
+    with patch.object(
+        crawler, "_get_repo_languages", return_value={"Python": 5, "Go": 1}
+    ) as mock_get:
+        crawler.get_language_usage()
+
+        mock_get.assert_called_once_with("repo2")
+
+    languages = db_session.query(DBLanguageUsage).all()
+    counts = {language.language: language.count for language in languages}
+    assert counts == {"Python": 15, "Go": 1}
+    assert (
+        crawler.language_counts.get("test_user/repo2")["pushed_at"]
+        == "2024-02-01T00:00:00Z"
+    )
+
+
+def test__count_lines_shouldreturnlines_whenresponseisok(crawler, tmp_path):
+    file_path = tmp_path / "file1.py"
+    file_path.write_bytes(b"line1\nline2\nline3\n")
+
+    assert crawler._count_lines(str(file_path)) == 3
+
+
+def test__count_lines_shouldcountlastline_whenfinalnewlineismissing(crawler, tmp_path):
+    file_path = tmp_path / "file1.py"
+    file_path.write_bytes(b"line1\nline2\nline3")
 
-    with patch("builtins.open", mock_open(read_data=mock_file_content)):
-        crawler._count_lines("dummy_path")
+    assert crawler._count_lines(str(file_path)) == 3
 
-    assert crawler.total_lines == 3
 
+def test__count_lines_shouldcountlines_whenfileisnotutf8(crawler, tmp_path):
+    file_path = tmp_path / "file1.py"
+    file_path.write_bytes("# caf\xe9\nprint()\n".encode("latin-1"))
 
-def test_get_total_lines_shouldupdatedb_whenresponseisok(crawler, db_session):
+    assert crawler._count_lines(str(file_path)) == 2
+
+
+def test__count_lines_shouldreturnzero_whenfileisbinaryoremptyormissing(
+    crawler, tmp_path
+):
+    binary_path = tmp_path / "binary.py"
+    binary_path.write_bytes(b"\x00\x01\n\n")
+    empty_path = tmp_path / "empty.py"
+    empty_path.write_bytes(b"")
+
+    assert crawler._count_lines(str(binary_path)) == 0
+    assert crawler._count_lines(str(empty_path)) == 0
+    assert crawler._count_lines(str(tmp_path / "missing.py")) == 0
+
+
+def test__count_lines_shouldcountacrossbuffers_whenfileislargerthanbuffer(
+    crawler, tmp_path
+):
+    file_path = tmp_path / "file1.py"
+    file_path.write_bytes(b"line\n" * 1000 + b"last")
+
+    with patch("crawler.lines.READ_BUFFER_SIZE", 7):
+        assert crawler._count_lines(str(file_path)) == 1001
+
+
+def test_get_total_lines_shouldupdatedb_whenresponseisok(
+    crawler, db_session, tmp_path, monkeypatch
+):
+    monkeypatch.chdir(tmp_path)
+    repo_path = tmp_path / "repos" / "test_user" / "repo1"
+    repo_path.mkdir(parents=True)
+    (repo_path / "file1.py").write_bytes(b"line1\nline2\nline3\n")
     crawler.repos = ["repo1"]
-    crawler.total_lines = 0
 
-    with patch("os.path.exists", return_value=True):
-        with patch.object(crawler, "_pull_repo"):
-            with patch("os.walk") as mock_walk:
-                mock_walk.return_value = [
-                    ("./repos/repo1", [], ["file1.py"]),
-                ]
+    with patch.object(crawler, "_pull_repo"):
+        crawler.get_total_lines()
+
+    lines = db_session.query(DBTotalLines).first()
+    assert lines.total_lines == 3
+
+
+def test_get_total_lines_shouldnotpullrepo_whenrepowasnotpushedsincelastcrawl(
+    crawler, db_session, tmp_path
+):
+    crawler.line_counts = JSONStore(str(tmp_path / "line_counts.json"))
+    crawler.line_counts.set(
+        "test_user/repo1",
+        {"sha": "abc", "lines": 42, "pushed_at": "2024-01-01T00:00:00Z"},
+    )
+    crawler.repos = ["repo1"]
+    crawler.repo_metadata = {
+        "repo1": {"name": "repo1", "pushed_at": "2024-01-01T00:00:00Z"}
+    }
+
+    with patch.object(crawler, "_pull_repo") as mock_pull:
+        with patch.object(crawler, "_clone_repo") as mock_clone:
+            crawler.get_total_lines()
+
+            mock_pull.assert_not_called()
+            mock_clone.assert_not_called()
+
+    lines = db_session.query(DBTotalLines).order_by(DBTotalLines.id.desc()).first()
+    assert lines.total_lines == 42
+
+
+def git(repo_path, *args):
+    subprocess.run(
+        ["git", "-C", str(repo_path), "-c", "user.name=test", "-c", "user.email=test"]
+        + list(args),
+        check=True,
+        capture_output=True,
+    )
+
+
+@pytest.fixture()
+def git_repo(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    repo_path = tmp_path / "repos" / "test_user" / "repo1"
+    repo_path.mkdir(parents=True)
+    git(repo_path, "init")
+    (repo_path / "main.py").write_text("line1\nline2\nline3\n")
+    (repo_path / "notes.txt").write_text("ignored\n")
+    git(repo_path, "add", ".")
+    git(repo_path, "commit", "-m", "initial")
+    return repo_path
+
+
+def test__count_repo_lines_shouldnotreadfiles_whenheadisunchanged(crawler, git_repo):
+    crawler.line_counts = JSONStore(str(git_repo.parent.parent / "line_counts.json"))
+
+    assert crawler._count_repo_lines("repo1") == 3
+
+    with patch.object(crawler, "_walk_files") as mock_walk:
+        assert crawler._count_repo_lines("repo1") == 3
+        mock_walk.assert_not_called()
+
+
+def test__count_repo_lines_shouldapplydiff_whenheadmoved(crawler, git_repo):
+    crawler.line_counts = JSONStore(str(git_repo.parent.parent / "line_counts.json"))
+    crawler._count_repo_lines("repo1")
+
+    (git_repo / "main.py").write_text("line1\n")
+    (git_repo / "app.js").write_text("a\nb\n")
+    (git_repo / "notes.txt").write_text("ignored\nignored\n")
+    git(git_repo, "add", ".")
+    git(git_repo, "commit", "-m", "change")
+
+    with patch.object(crawler, "_walk_files") as mock_walk:
+        assert crawler._count_repo_lines("repo1") == 3
+        mock_walk.assert_not_called()
+
+    assert crawler._walk_files("repo1") == 3
+
+
+def test__count_repo_lines_shouldrecount_whenfilebecamebinary(crawler, git_repo):
+    crawler.line_counts = JSONStore(str(git_repo.parent.parent / "line_counts.json"))
+    crawler._count_repo_lines("repo1")
+
+    (git_repo / "main.py").write_bytes(b"\x00binary\n")
+    with open(os.path.join(bytes(git_repo), b"caf\xe9.py"), "wb") as f:
+        f.write(b"a\nb\n")
+    git(git_repo, "add", ".")
+    git(git_repo, "commit", "-m", "binary")
+
+    assert crawler._count_repo_lines("repo1") == crawler._walk_files("repo1") == 2
+
+
+def test__count_repo_lines_shouldreturnzero_whenrepoisempty(
+    crawler, tmp_path, monkeypatch
+):
+    monkeypatch.chdir(tmp_path)
+    repo_path = tmp_path / "repos" / "test_user" / "repo1"
+    repo_path.mkdir(parents=True)
+    git(repo_path, "init")
+    crawler.line_counts = JSONStore(str(tmp_path / "line_counts.json"))
+    crawler.blob_cache = BlobLineCache(str(tmp_path / "blob_lines.json"))
+
+    assert crawler._count_repo_lines("repo1") == 0
+
+
+def test__walk_files_shouldmatchserialcount_whencountinginparallel(
+    crawler, tmp_path, monkeypatch
+):
+    monkeypatch.chdir(tmp_path)
+    repo_path = tmp_path / "repos" / "test_user" / "repo1"
+    for i in range(20):
+        directory = repo_path / f"dir{i % 3}"
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / f"file{i}.py").write_text("line\n" * i)
+    (repo_path / "binary.py").write_bytes(b"\x00\xfe\n")
+
+    serial_lines = crawler._walk_files("repo1")
+
+    with patch("crawler.crawler.LINE_COUNT_BATCH_SIZE", 4):
+        with ProcessPoolExecutor(max_workers=2) as pool:
+            crawler.pool = pool
+            parallel_lines = crawler._walk_files("repo1")
+            crawler.pool = None
+
+    assert serial_lines == sum(range(20))
+    assert parallel_lines == serial_lines
+
+
+def test__count_blobs_shouldmatchworkingtreecount_whencountingfromobjectstore(
+    crawler, git_repo
+):
+    (git_repo / "app.js").write_bytes(b"a\nb")
+    (git_repo / "image.py").write_bytes(b"\x00binary\n")
+    git(git_repo, "add", ".")
+    git(git_repo, "commit", "-m", "more files")
+    git(git_repo.parent, "clone", "--bare", "repo1", "repo1.git")
 
-                with patch(
-                    "builtins.open", mock_open(read_data="line1\nline2\nline3\n")
-                ):
-                    crawler.get_total_lines()
+    working_tree_lines = crawler._walk_files("repo1")
+    crawler.object_store = True
+    object_store_lines = crawler._count_blobs("repo1")
 
-                lines = db_session.query(DBTotalLines).first()
-                assert lines.total_lines == 3
+    assert working_tree_lines == 5
+    assert object_store_lines == working_tree_lines
+
+
+def test_blob_line_cache_shouldevictleastrecentlyused_whenfull(tmp_path):
+    cache = BlobLineCache(str(tmp_path / "blob_lines.json"), max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    cache.save()
+
+    cache = BlobLineCache(str(tmp_path / "blob_lines.json"), max_size=2)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test__count_blobs_shouldcounteachblobonce_whensharedacrossrepos(
+    crawler, git_repo, tmp_path
+):
+    git(git_repo.parent, "clone", "repo1", "repo2")
+    crawler.blob_cache = BlobLineCache(str(tmp_path / "blob_lines.json"))
+
+    with patch("crawler.crawler.count_file_lines", return_value=3) as mock_count:
+        assert crawler._count_blobs("repo1") == 3
+        assert crawler._count_blobs("repo2") == 3
+
+        assert mock_count.call_count == 1
+
+
+def test_get_total_lines_shouldcountsyncedrepos_whensyncingconcurrently(
+    crawler, db_session
+):
+    crawler.repos = ["repo1", "repo2", "repo3"]
+    crawler.git_concurrency = 3
+
+    def sync(repo, i):
+        if repo == "repo2":
+            raise subprocess.CalledProcessError(1, "git")
+        return 0.0
+
+    with patch.object(crawler, "_sync_repo", side_effect=sync):
+        with patch.object(crawler, "_count_repo_lines", return_value=10) as mock_count:
+            crawler.get_total_lines()
+
+            counted = sorted(call.args[0] for call in mock_count.call_args_list)
+            assert counted == ["repo1", "repo3"]
+
+    lines = db_session.query(DBTotalLines).order_by(DBTotalLines.id.desc()).first()
+    assert lines.total_lines == 20
+
+
+def test_get_total_lines_shouldkeeppushedat_whenpullfails(crawler, git_repo):
+    crawler.line_counts = JSONStore(str(git_repo.parent.parent / "line_counts.json"))
+    crawler.repos = ["repo1"]
+    crawler.repo_metadata = {"repo1": {"pushed_at": "2024-01-01T00:00:00Z"}}
+    with patch.object(crawler, "_pull_repo"):
+        crawler.get_total_lines()
+
+    crawler.repo_metadata = {"repo1": {"pushed_at": "2024-02-01T00:00:00Z"}}
+    with patch.object(
+        crawler, "_pull_repo", side_effect=subprocess.CalledProcessError(1, "git")
+    ):
+        crawler.get_total_lines()
+
+    stored = crawler.line_counts.get("test_user/repo1")
+    assert stored["pushed_at"] == "2024-01-01T00:00:00Z"
+    assert not crawler._is_unchanged(crawler.line_counts, "repo1")
+
+
+def test__clone_repo_shouldcloneshallow_whennolinecountsarestored(crawler):
+    with patch("subprocess.run") as mock_run:
+        crawler._clone_repo("repo1", 0)
+        assert "--depth" in mock_run.call_args.args[0]
+
+        crawler.line_counts = {}
+        crawler._clone_repo("repo1", 0)
+        assert "--filter=blob:none" in mock_run.call_args.args[0]
+
+
+def test_requester_shouldretrywithbackoff_whenservererror():
+    sleeps = []
+    requester = Requester(sleep=sleeps.append)
+    responses = [make_response(502), make_response(503), make_response(200, b"{}")]
+
+    with patch("requests.Session.request", side_effect=responses) as mock_request:
+        response = requester.request("GET", "https://api.github.com/users/u/repos")
+
+    assert response.status_code == 200
+    assert mock_request.call_count == 3
+    assert len(sleeps) == 2
+    assert 0 <= sleeps[0] <= 1 and 0 <= sleeps[1] <= 2
+
+
+def test_requester_shouldwaitretryafter_whensecondaryratelimited():
+    sleeps = []
+    requester = Requester(sleep=sleeps.append)
+    responses = [
+        make_response(403, headers={"Retry-After": "30"}),
+        make_response(200, b"{}"),
+    ]
+
+    with patch("requests.Session.request", side_effect=responses):
+        response = requester.request("POST", "https://api.github.com/graphql")
+
+    assert response.status_code == 200
+    assert sleeps == [30.0]
+
+
+@pytest.mark.parametrize(
+    "retry_after, expected",
+    [("Thu, 01 Jan 1970 00:17:10 GMT", 30.0), ("soon", None)],
+)
+def test_requester_shouldparseretryafter_whenvalueisnotseconds(retry_after, expected):
+    sleeps = []
+    requester = Requester(clock=lambda: 1000, sleep=sleeps.append)
+    responses = [
+        make_response(429, headers={"Retry-After": retry_after}),
+        make_response(200, b"{}"),
+    ]
+
+    with patch("requests.Session.request", side_effect=responses):
+        response = requester.request("GET", "https://api.github.com/users/u/repos")
+
+    assert response.status_code == 200
+    if expected is None:
+        assert 0 <= sleeps[0] <= 1
+    else:
+        assert sleeps == [expected]
+
+
+def test_requester_shouldwaituntilreset_whenbudgetisexhausted():
+    sleeps = []
+    requester = Requester(clock=lambda: 1000, sleep=sleeps.append)
+    responses = [
+        make_response(
+            403,
+            headers={"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "1060"},
+        ),
+        make_response(200, b"{}"),
+    ]
+
+    with patch("requests.Session.request", side_effect=responses):
+        requester.request("GET", "https://api.github.com/users/u/repos")
+
+    assert 60 <= sleeps[0] <= 61
+
+
+def test_requester_shouldnotretry_whenclienterror():
+    requester = Requester(sleep=lambda _: pytest.fail("should not sleep"))
+
+    with patch(
+        "requests.Session.request", return_value=make_response(404)
+    ) as mock_request:
+        response = requester.request("GET", "https://api.github.com/repos/u/r")
+
+    assert response.status_code == 404
+    assert mock_request.call_count == 1
+
+
+def test_token_bucket_shouldspreadremainingbudget_whenbudgetislow():
+    now = [0.0]
+    sleeps = []
+    bucket = TokenBucket(clock=lambda: now[0], sleep=sleeps.append)
+
+    bucket.update(remaining=10, seconds_to_reset=100)
+    for _ in range(11):
+        bucket.acquire()
+
+    assert sleeps == [pytest.approx(10.0)]
+
+
+def test_requester_shouldreusepooledsessionwithtimeouts_whensendingrequests():
+    requester = Requester(pool_size=4, timeout=(1, 2))
+
+    with patch(
+        "requests.Session.request", return_value=make_response(200, b"{}")
+    ) as mock_request:
+        requester.request("GET", "https://api.github.com/users/u/repos")
+        requester.request("POST", "https://api.github.com/graphql")
+
+    assert all(call.kwargs["timeout"] == (1, 2) for call in mock_request.call_args_list)
+    assert requester.http.get_adapter("https://api.github.com")._pool_maxsize == 4
+
+
+def test_run_shouldcrawlallstages_whenrunagainstfakegithub(
+    db_session, tmp_path, monkeypatch
+):
+    monkeypatch.chdir(tmp_path)
+    origin = tmp_path / "origin"
+    languages = make_repos(str(origin), "test_user", 2, 8, 10)
+
+    with FakeGitHub("test_user", languages) as github:
+        crawler = Crawler(
+            username="test_user",
+            token="test_token",
+            db=db_session,
+            line_counts=JSONStore(str(tmp_path / "line_counts.json")),
+            api_url=github.url,
+            clone_url=f"file://{origin}",
+        )
+        crawler.run()
+
+    lines = db_session.query(DBTotalLines).one()
+    languages = db_session.query(DBLanguageUsage).all()
+    assert lines.total_lines == 2 * 6 * 10
+    assert {language.language for language in languages} == {
+        "Python",
+        "JavaScript",
+        "Go",
+    }
+    assert db_session.query(DBLastYearContributions).count() > 0
+    assert db_session.query(DBTotalContributions).one().total_contributions > 0
+
+
+def test_find_regressions_shouldreportstage_whenslowerthanbaseline():
+    baseline = {"results": {"cold": {"total_lines": 1.0, "repos": 0.1}}}
+    results = {"cold": {"total_lines": 2.0, "repos": 0.15}}
+
+    regressions = find_regressions(results, baseline, tolerance=0.5)
+
+    assert regressions == ["cold/total_lines: 2.000s, baseline 1.000s"]
+
+
+def test_upgrade_schema_shouldaddruncolumns_whentablespredateruns(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "CREATE TABLE total_lines (id INTEGER PRIMARY KEY, "
+                "total_lines INTEGER, date_created DATETIME)"
+            )
+        )
+        connection.execute(text("INSERT INTO total_lines VALUES (1, 42, NULL)"))
+
+    upgrade_schema(engine)
+    upgrade_schema(engine)
+
+    inspector = inspect(engine)
+    columns = {column["name"] for column in inspector.get_columns("total_lines")}
+    indexes = {index["name"] for index in inspector.get_indexes("total_lines")}
+    assert "run_id" in columns
+    assert "ix_total_lines_run_id" in indexes
+    assert "username" in {
+        column["name"] for column in inspector.get_columns("crawl_runs")
+    }
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT run_id FROM total_lines")).all() == [
+            (None,)
+        ]
+    engine.dispose()